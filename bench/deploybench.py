@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Reproducible deployment benchmarks for BOSS.
+
+Generates project trees for a set of scenarios, starts a stand-in SSH/SFTP
+server per fake host (see sshstub.py) and runs server.deploy() against them,
+reporting the wall time, round trips, bytes transferred and the time spent in
+each phase.  Results can be saved as baselines and later runs compared against
+them to catch regressions.
+
+Usage: deploybench.py [options] [scenario ...]
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import logging
+import optparse
+import tempfile
+
+__install__ = os.path.realpath(os.path.join(sys.path[0], ".."))
+
+# The stand-in paths that get re-rooted on each fake host
+DEPLOY_PATH = "/srv/bench"
+REMOTE_CACHE = "/var/cache/boss"
+
+def write(path, data, mode=0644):
+    """
+    Function to write a file, creating its directory as needed.
+    """
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, "wb") as outfile:
+        outfile.write(data)
+    os.chmod(path, mode)
+
+def small_files(project, rnd, scale):
+    """
+    Scenario with a pkg/ tree of many small files.
+    """
+
+    for count in range(int(2000 * scale)):
+        write(os.path.join(project, "pkg", "lib{0:02d}".format(count % 40), "file{0:05d}.txt".format(count)), "x" * rnd.randint(64, 4096))
+
+def large_files(project, rnd, scale):
+    """
+    Scenario with a pkg/ tree holding a few large, incompressible files.
+    """
+
+    for count in range(3):
+        write(os.path.join(project, "pkg", "dist", "artifact{0}.bin".format(count)), os.urandom(int(16 * 1048576 * scale)))
+
+def many_scripts(project, rnd, scale):
+    """
+    Scenario with many small scripts to run.
+    """
+
+    for count in range(int(100 * scale)):
+        write(os.path.join(project, "scripts", "{0:03d}-step".format(count)), "#!/bin/sh\necho step {0} $PROJECT $ENVIRONMENT\n".format(count), 0755)
+
+def large_templates(project, rnd, scale):
+    """
+    Scenario with large templates and a properties file of many keys.
+    """
+
+    keys = ["KEY_{0:04d}".format(count) for count in range(2000)]
+    properties = ["{0}=value-{1}".format(key, rnd.randint(0, 1000000)) for key in keys]
+    properties.append("NESTED=@KEY_0001@/@KEY_0002@")
+    write(os.path.join(project, "conf", "bench-bench.properties"), "\n".join(properties) + "\n")
+
+    for count in range(int(20 * scale)):
+        lines = []
+        for line in range(5000):
+            if line % 3:
+                lines.append("plain line {0} with no tokens at all".format(line))
+            else:
+                lines.append("setting.{0} = @{1}@ and @NESTED@".format(line, rnd.choice(keys)))
+        write(os.path.join(project, "templates", "etc", "app{0:02d}.conf".format(count)), "\n".join(lines) + "\n")
+
+SCENARIOS = [
+    ("small-files", small_files),
+    ("large-files", large_files),
+    ("many-scripts", many_scripts),
+    ("large-templates", large_templates),
+]
+
+def build_install(workdir, scenario, scale, hosts, keyfile, settings):
+    """
+    Function to lay out a throwaway BOSS installation holding a generated project.
+    """
+
+    install = os.path.join(workdir, "install")
+    project = os.path.join(install, "projects", "bench")
+
+    # The real remote helpers, so their cost is measured too
+    for name in os.listdir(os.path.join(__install__, "bin")):
+        if name.endswith(".py"):
+            write(os.path.join(install, "bin", name), open(os.path.join(__install__, "bin", name)).read(), 0755)
+
+    write(os.path.join(install, "conf", "boss.conf"), "[BOSS]\nssh user = bench\nssh key = {0}\n".format(keyfile))
+    write(os.path.join(install, "common", "scripts", "00-common"), "#!/bin/sh\necho common $CONTEXT\n", 0755)
+
+    # Every project gets at least something in each directory
+    write(os.path.join(project, "pkg", "VERSION"), "1.0\n")
+    write(os.path.join(project, "templates", "etc", "version.conf"), "version=@VERSION@\n")
+    write(os.path.join(project, "conf", "bench-bench.properties"), "VERSION=1.0\n")
+    write(os.path.join(project, "scripts", "000-start"), "#!/bin/sh\necho start\n", 0755)
+
+    scenario(project, random.Random(1), scale)
+
+    projconf = ["[PROJECT]", "bench = {0}".format(",".join(str(host) for host in hosts)), "deploy path = {0}".format(DEPLOY_PATH)]
+    projconf.extend("{0} = {1}".format(name, value) for (name, value) in settings)
+    write(os.path.join(project, "project.conf"), "\n".join(projconf) + "\n")
+
+    return install
+
+def run(scenario, options, settings, keyfile):
+    """
+    Function to run a single scenario and return its measurements.
+    """
+
+    import Boss
+    import sshstub
+
+    workdir = tempfile.mkdtemp(prefix="boss-bench-")
+    hosts = [sshstub.stubhost("host{0}".format(count), ["/tmp/BOSS-", DEPLOY_PATH, REMOTE_CACHE]) for count in range(options.hosts)]
+
+    try:
+        Boss.__install__ = build_install(workdir, scenario, options.scale, hosts, keyfile, settings)
+
+        runs = []
+        for attempt in range(options.runs):
+            for host in hosts:
+                host.counters.reset()
+
+            started = time.time()
+            system = Boss.server("bench", "bench", "bench")
+            system.report = Boss.report()
+            system.deploy(options.parallel)
+            elapsed = time.time() - started
+
+            totals = {}
+            for host in hosts:
+                for (counter, value) in host.counters.snapshot().iteritems():
+                    totals[counter] = totals.get(counter, 0) + value
+
+            runs.append({
+                "wall time": round(elapsed, 3),
+                "round trips": totals.get("round trips", 0),
+                "bytes": totals.get("bytes", 0),
+            })
+
+        # Time per phase, summed over the hosts, for the last run
+        phases = system.report.summary()["phases"]
+
+        result = dict(runs[-1])
+        result["phases"] = dict((phase, phases[phase]["seconds"]) for phase in Boss.report.toplevel if phase in phases)
+        result["runs"] = runs
+
+        return result
+    finally:
+        for host in hosts:
+            host.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(result, baseline, tolerance):
+    """
+    Function to compare a result with its baseline.
+
+    Returns: A list of regressions found
+    """
+
+    regressions = []
+
+    if result["wall time"] > baseline["wall time"] * (1 + tolerance):
+        regressions.append("wall time {0}s, baseline {1}s".format(result["wall time"], baseline["wall time"]))
+
+    # Round trips and bytes are deterministic enough to need only a little slack
+    for measure in ("round trips", "bytes"):
+        if result[measure] > baseline[measure] * 1.01:
+            regressions.append("{0} {1}, baseline {2}".format(measure, result[measure], baseline[measure]))
+
+    return regressions
+
+def main():
+    """
+    Function to act as the main loop.
+    """
+
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option("-n", "--hosts", dest="hosts", type="int", default=4, help="The number of fake hosts to deploy to.")
+    parser.add_option("-j", "--parallel", dest="parallel", type="int", default=1, help="The number of hosts to deploy to concurrently.")
+    parser.add_option("-r", "--runs", dest="runs", type="int", default=2, help="The number of deployments per scenario; later runs see a warm host.")
+    parser.add_option("-x", "--scale", dest="scale", type="float", default=1.0, help="Scale the size of the generated trees.")
+    parser.add_option("-s", "--set", dest="settings", action="append", default=[], help="A project.conf setting for every scenario, e.g. \"transfer mode=archive\".")
+    parser.add_option("--relay", dest="relay", action="store_true", default=False, help="Distribute pkg/ through relay hosts using ssh(1).")
+    parser.add_option("-b", "--baselines", dest="baselines", default=os.path.join(__install__, "bench", "baselines.json"), help="The baselines file.")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type="float", default=0.25, help="The allowed slowdown in wall time before flagging a regression.")
+    parser.add_option("--save", dest="save", action="store_true", default=False, help="Save the results as the new baselines.")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help="Show the deployment output.")
+    (options, args) = parser.parse_args()
+
+    scenarios = [(name, function) for (name, function) in SCENARIOS if not args or name in args]
+    if not scenarios:
+        parser.error("No such scenario; choose from: {0}".format(", ".join(name for (name, function) in SCENARIOS)))
+
+    settings = []
+    for setting in options.settings:
+        (name, value) = setting.split("=", 1)
+        settings.append((name.strip(), value.strip()))
+
+    # Make BOSS and the stand-in server importable
+    sys.path.append(os.path.join(__install__, "lib"))
+    sys.path.append(os.path.join(__install__, "bench"))
+
+    import paramiko
+    import Boss
+
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    if not options.verbose:
+        Boss.bosslog.setLevel(logging.WARNING)
+        logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    # A throwaway client identity; the stand-ins accept any key
+    keydir = tempfile.mkdtemp(prefix="boss-bench-key-")
+    keyfile = os.path.join(keydir, "id_rsa")
+    paramiko.RSAKey.generate(1024).write_private_key_file(keyfile)
+
+    # Baselines are kept per scenario and per combination of settings
+    suffix = "".join(" [{0}={1}]".format(name, value) for (name, value) in sorted(settings))
+
+    # The relays reach the other stand-ins with the same throwaway identity
+    if options.relay:
+        settings.append(("distribution", "relay"))
+        suffix += " [relay]"
+        settings.append(("relay command", "ssh -i {0} -o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR -o HostKeyAlgorithms=+ssh-rsa -o PubkeyAcceptedAlgorithms=+ssh-rsa -p {{port}} {{user}}@{{address}} 'mkdir -m 700 {{directory}} && cat > {{payload}}' < {{payload}}".format(keyfile)))
+
+    baselines = {}
+    if os.path.exists(options.baselines):
+        baselines = json.load(open(options.baselines))
+
+    regressed = False
+    try:
+        for (name, function) in scenarios:
+            key = "{0} x{1}{2}".format(name, options.hosts, suffix)
+            result = run(function, options, settings, keyfile)
+
+            print "{0}: {1}s, {2} round trips, {3} bytes".format(key, result["wall time"], result["round trips"], result["bytes"])
+            for (phase, seconds) in sorted(result["phases"].iteritems()):
+                print "| {0}: {1}s".format(phase, seconds)
+
+            if options.save:
+                baselines[key] = result
+            elif key in baselines:
+                for regression in compare(result, baselines[key], options.tolerance):
+                    print "| REGRESSION: {0}".format(regression)
+                    regressed = True
+    finally:
+        shutil.rmtree(keydir, ignore_errors=True)
+
+    if options.save:
+        with open(options.baselines, "w") as outfile:
+            json.dump(baselines, outfile, indent=2, sort_keys=True)
+
+    return not regressed
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""
+Local, in-process stand-ins for the remote hosts BOSS deploys to.
+
+Each stand-in host listens on a loopback port, accepts any credentials and
+owns a temporary directory that acts as its filesystem root.  SFTP requests
+are re-rooted into that directory, as are any absolute paths in exec'd
+commands that start with one of the host's known prefixes (the BOSS temporary
+directory and the deployment path, for example).  Commands themselves run on
+the local machine through /bin/sh.
+"""
+
+import os
+import re
+import errno
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import paramiko
+
+class counters():
+    """
+    Class to hold thread-safe counters of round trips and bytes transferred.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, amount=1):
+        """
+        Class method to increment a named counter.
+        """
+
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        Class method to return a copy of the current counter values.
+        """
+
+        with self.lock:
+            return dict(self.values)
+
+    def reset(self):
+        """
+        Class method to zero all counters.
+        """
+
+        with self.lock:
+            self.values = {}
+
+class stubserver(paramiko.ServerInterface):
+    """
+    Class to answer the SSH server-side requests for a stand-in host.
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.host.counters.add("round trips")
+        self.host.counters.add("commands")
+        worker = threading.Thread(target=self.host.run, args=(channel, command))
+        worker.daemon = True
+        worker.start()
+        return True
+
+    def check_channel_forward_agent_request(self, channel):
+        return True
+
+class stubhandle(paramiko.SFTPHandle):
+    """
+    Class for an open file on a stand-in host that counts the bytes written.
+    """
+
+    def write(self, offset, data):
+        self.host.counters.add("bytes", len(data))
+        return paramiko.SFTPHandle.write(self, offset, data)
+
+class stubsftp(paramiko.SFTPServerInterface):
+    """
+    Class to serve SFTP requests from a stand-in host's root directory.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        self.host = server.host
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+
+    def _path(self, path):
+        return self.host.translate_path(path)
+
+    def _attributes(self, path, stat):
+        attr = paramiko.SFTPAttributes.from_stat(stat)
+        attr.filename = os.path.basename(path)
+        return attr
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [self._attributes(os.path.join(path, name), os.lstat(os.path.join(path, name))) for name in os.listdir(path)]
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return self._attributes(path, os.stat(self._path(path)))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return self._attributes(path, os.lstat(self._path(path)))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            mode = getattr(attr, "st_mode", None) or 0666
+            fd = os.open(path, flags | getattr(os, "O_BINARY", 0), mode)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            fstr = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            fstr = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            fstr = "rb"
+
+        handle = stubhandle(flags)
+        handle.host = self.host
+        handle.filename = path
+        handle.readfile = os.fdopen(fd, fstr)
+        handle.writefile = handle.readfile
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._path(path), attr)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def symlink(self, target_path, path):
+        try:
+            os.symlink(target_path, self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+class countingsftpserver(paramiko.SFTPServer):
+    """
+    Class for an SFTP subsystem that counts every request as a round trip.
+    """
+
+    def _process(self, t, request_number, msg):
+        self.server.host.counters.add("round trips")
+        self.server.host.counters.add("sftp requests")
+        return paramiko.SFTPServer._process(self, t, request_number, msg)
+
+class stubhost():
+    """
+    Class for a single stand-in host listening on a loopback port.
+    """
+
+    hostkey = None
+
+    def __init__(self, name, prefixes, root=None):
+        self.name = name
+        self.prefixes = list(prefixes)
+        self.root = root or tempfile.mkdtemp(prefix="boss-stub-{0}-".format(name))
+        self.counters = counters()
+
+        # As on a real host, the directories holding the known paths already exist
+        for prefix in self.prefixes:
+            parent = self.root + os.path.dirname(prefix)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+        # Share a single host key between every stand-in; generating one is slow
+        if stubhost.hostkey is None:
+            stubhost.hostkey = paramiko.RSAKey.generate(1024)
+
+        # Only re-root paths that start with a known prefix, and only when the
+        # prefix starts a word; i.e. isn't already part of a re-rooted path
+        pattern = "|".join(re.escape(prefix) for prefix in sorted(self.prefixes, key=len, reverse=True))
+        self.prefix_re = re.compile("(?<![\\w./-])({0})".format(pattern))
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+
+        self.acceptor = threading.Thread(target=self.accept)
+        self.acceptor.daemon = True
+        self.acceptor.start()
+
+    def __str__(self):
+        return "127.0.0.1:{0}".format(self.port)
+
+    def translate_path(self, path):
+        """
+        Class method to map an absolute remote path into this host's root.
+        """
+
+        return os.path.join(self.root, os.path.normpath(path).lstrip("/"))
+
+    def translate_command(self, command):
+        """
+        Class method to map the known absolute paths in a command into this host's root.  Single
+        quoted parts are left alone; they're run by another host, as when relaying over ssh(1).
+        """
+
+        parts = command.split("'")
+        for count in range(0, len(parts), 2):
+            parts[count] = self.prefix_re.sub(lambda match: self.root + match.group(1), parts[count])
+
+        return "'".join(parts)
+
+    def accept(self):
+        """
+        Class method to accept incoming connections until the listener is closed.
+        """
+
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except (socket.error, OSError):
+                return
+
+            self.counters.add("connections")
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.hostkey)
+            transport.set_subsystem_handler("sftp", countingsftpserver, stubsftp)
+            transport.server_object = stubserver(self)
+            try:
+                transport.start_server(server=transport.server_object)
+            except (paramiko.SSHException, EOFError, socket.error):
+                continue
+            self.transports.append(transport)
+
+    def run(self, channel, command):
+        """
+        Class method to run an exec request locally and relay its I/O over the channel.
+        """
+
+        process = subprocess.Popen(self.translate_command(command), shell=True,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   cwd=self.root, close_fds=True)
+
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    self.counters.add("bytes", len(data))
+                    process.stdin.write(data)
+            except (IOError, OSError, socket.error):
+                pass
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        while True:
+            data = os.read(process.stdout.fileno(), 32768)
+            if not data:
+                break
+            channel.sendall(data)
+
+        status = process.wait()
+        channel.send_exit_status(status)
+        channel.shutdown_write()
+        channel.close()
+
+    def close(self):
+        """
+        Class method to stop listening, drop connections and remove the host's root.
+        """
+
+        try:
+            self.listener.close()
+        except socket.error:
+            pass
+        for transport in self.transports:
+            transport.close()
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -6,6 +6,7 @@ import os
 import logging
 import optparse
 import traceback
+import ConfigParser
 
 __install__ = os.path.realpath(os.path.join(sys.path[0], ".."))
 
@@ -33,12 +34,26 @@ if __name__ == "__main__":
 
     Options:
       -h, --help            show this help message and exit
-      -p PROJECT, --project=PROJECT
-                            The project scripts to execute.
+      -p PROJECTS, --project=PROJECTS
+                            The project scripts to execute.  May be repeated,
+                            paired in order with -c.
       -e ENVIRONMENT, --env=ENVIRONMENT
                             The environment to deploy to.
-      -c CONTEXT, --context=CONTEXT
-                            The context of the project.
+      -c CONTEXTS, --context=CONTEXTS
+                            The context of the project.  May be repeated, paired
+                            in order with -p.
+      -j PARALLEL, --parallel=PARALLEL
+                            The number of hosts to deploy to concurrently.
+      -r REPORT, --report=REPORT
+                            Write a JSON report of the timings for every host and
+                            phase to this file.
+      --rollback            Point every host back at its previous release rather
+                            than deploying.
+      --log-dir=LOGDIR      Also write the output for each host to its own file
+                            in this directory.
+      --log-format=LOGFORMAT
+                            The format of the log output: text or json (one
+                            object per line).
     """
 
     # Add the local lib/ directory to the Python path
@@ -57,24 +72,43 @@ if __name__ == "__main__":
     otherfilter = SingleLevelFilter(logging.INFO, True)
     stderr.addFilter(otherfilter)
 
-    # Add the filters to the root logger
-    rootlogger = logging.getLogger()
-    rootlogger.addHandler(stdout)
-    rootlogger.addHandler(stderr)
-
     # Get the command line options
     parser = optparse.OptionParser()
-    parser.add_option("-p", "--project", dest="project", help="The project scripts to execute.")
+    parser.add_option("-p", "--project", dest="projects", action="append", help="The project scripts to execute.  May be repeated, paired in order with -c.")
     parser.add_option("-e", "--env", dest="environment", help="The environment to deploy to.")
-    parser.add_option("-c", "--context", dest="context", help="The context of the project.")
+    parser.add_option("-c", "--context", dest="contexts", action="append", help="The context of the project.  May be repeated, paired in order with -p.")
+    parser.add_option("-j", "--parallel", dest="parallel", type="int", default=1, help="The number of hosts to deploy to concurrently.")
+    parser.add_option("-r", "--report", dest="report", help="Write a JSON report of the timings for every host and phase to this file.")
     parser.add_option("-l", "--loglevel", dest="loglevel", help="The loglevel of the project.  e.g. DEBUG, INFO, WARN, ERROR")
+    parser.add_option("--rollback", dest="rollback", action="store_true", default=False, help="Point every host back at its previous release rather than deploying.")
+    parser.add_option("--log-dir", dest="logdir", help="Also write the output for each host to its own file in this directory.")
+    parser.add_option("--log-format", dest="logformat", choices=["text", "json"], default="text", help="The format of the log output: text or json (one object per line).")
     (options, args) = parser.parse_args()
 
+    # Write the log output from a background thread, so the deployment doesn't wait on it
+    sink = Boss.logsink([stdout, stderr], options.logdir)
+    if options.logformat == "json":
+        for handler in (stdout, stderr, sink):
+            handler.setFormatter(Boss.jsonformatter())
+
+    # Add the sink to the root logger
+    rootlogger = logging.getLogger()
+    rootlogger.addHandler(sink)
+
     # Ensure all three 'options' are provided
-    if (not options.project or not options.environment or not options.context):
+    if (not options.projects or not options.environment or not options.contexts):
         Boss.bosslog.error(parser.print_help())
         sys.exit(1)
 
+    # Pair up the projects and contexts; a single one of either goes with all of the other
+    if len(options.projects) == 1:
+        options.projects = options.projects * len(options.contexts)
+    elif len(options.contexts) == 1:
+        options.contexts = options.contexts * len(options.projects)
+    if len(options.projects) != len(options.contexts):
+        Boss.bosslog.error("Each project (-p) needs a context (-c) to go with it.")
+        sys.exit(1)
+
     # Set the logging level, if provided
     if options.loglevel:
         try:
@@ -83,12 +117,46 @@ if __name__ == "__main__":
         except AttributeError:
             raise Exception("""No such logging level as "{0}".""".format(options.loglevel))
 
+    # Collect timings if a report is wanted
+    report = None
+    if options.report:
+        report = Boss.report()
+
+    # Share connections to the same hosts between the deployments, limited by the main configuration
+    bossconf = ConfigParser.ConfigParser()
+    bossconf.read(os.path.join(__install__, "conf", "boss.conf"))
+    try:
+        maxopen = bossconf.getint("BOSS", "max connections")
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+        maxopen = 256
+
+    connections = Boss.connections()
+    connections.maxopen = maxopen if maxopen > 0 else None
+
     # GO!
+    failed = False
     try:
-        system = Boss.server(options.project, options.environment, options.context)
-        system.deploy()
+        for (project, context) in zip(options.projects, options.contexts):
+            system = Boss.server(project, options.environment, context)
+            system.report = report
+            system.connections = connections
+            if options.rollback:
+                system.rollback(options.parallel)
+            else:
+                system.deploy(options.parallel)
     except Exception, e:
+        failed = True
         Boss.bosslog.error("There was an error: {0}".format(e))
         if Boss.bosslog.getEffectiveLevel() == logging.DEBUG:
-            # Print a traceback to help work out any issues
+            # Print a traceback to help work out any issues, after the log output so far
+            sink.flush()
             traceback.print_exc(file=sys.stdout)
+    finally:
+        connections.close()
+        if report is not None:
+            report.write(options.report)
+            Boss.bosslog.info("Wrote the deployment report to {0}".format(options.report))
+        sink.close()
+
+    if failed:
+        sys.exit(1)
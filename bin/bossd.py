@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Base libraries
+import sys
+import os
+import logging
+import optparse
+
+__install__ = os.path.realpath(os.path.join(sys.path[0], ".."))
+
+if __name__ == "__main__":
+    """
+    Usage: bossd.py [options]
+
+    Runs BOSS as a long-running service, taking deployment jobs over HTTP.
+
+    Options:
+      -h, --help            show this help message and exit
+      -a ADDRESS, --address=ADDRESS
+                            The address to listen on.
+      -P PORT, --port=PORT  The port to listen on.
+      -l LOGLEVEL, --loglevel=LOGLEVEL
+                            The loglevel of the daemon.  e.g. DEBUG, INFO, WARN,
+                            ERROR
+      --log-dir=LOGDIR      Also write the output for each host to its own file
+                            in this directory.
+
+    API:
+      POST /jobs            Queue a job: {"project": ..., "environment": ...,
+                            "context": ..., "parallel": 1, "rollback": false}
+      GET  /jobs            Describe every job.
+      GET  /jobs/<id>       Describe a job, with its report once finished.
+      GET  /jobs/<id>/log   Stream a job's output until it has finished.
+    """
+
+    # Add the local lib/ directory to the Python path
+    sys.path.append(os.path.join(__install__, "lib"))
+
+    # Import the main BOSS module, and the logging set up shared with boss.py
+    import Boss
+    from boss import SingleLevelFilter
+
+    # Get the command line options
+    parser = optparse.OptionParser()
+    parser.add_option("-a", "--address", dest="address", default="127.0.0.1", help="The address to listen on.")
+    parser.add_option("-P", "--port", dest="port", type="int", default=8022, help="The port to listen on.")
+    parser.add_option("-l", "--loglevel", dest="loglevel", help="The loglevel of the daemon.  e.g. DEBUG, INFO, WARN, ERROR")
+    parser.add_option("--log-dir", dest="logdir", help="Also write the output for each host to its own file in this directory.")
+    (options, args) = parser.parse_args()
+
+    # Send INFO logging to stdout and all other levels to stderr, from a background thread
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.addFilter(SingleLevelFilter(logging.INFO, False))
+    stderr = logging.StreamHandler(sys.stderr)
+    stderr.addFilter(SingleLevelFilter(logging.INFO, True))
+
+    sink = Boss.logsink([stdout, stderr], options.logdir)
+    logging.getLogger().addHandler(sink)
+
+    # Set the logging level, if provided
+    if options.loglevel:
+        try:
+            Boss.bosslog.setLevel(getattr(logging, options.loglevel.upper()))
+        except AttributeError:
+            raise Exception("""No such logging level as "{0}".""".format(options.loglevel))
+
+    service = Boss.daemon()
+    httpd = Boss.httpserver((options.address, options.port), service)
+    Boss.bosslog.info("Listening on {0}:{1}".format(options.address, options.port))
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.close()
+        sink.close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+A content-addressed file cache for remote hosts.  Files are stored by key
+(checksum, size and mode) and materialised into a deployment tree as hard
+links, with the least recently used entries evicted to keep the cache within
+a size limit.  As a file edited in place through one of those links changes
+its entry too, entries are checked against their checksum before they're
+used again.
+
+Usage:
+    cache.py -c CACHEDIR query            (reads keys, writes those present)
+    cache.py -c CACHEDIR -d DEST link     (reads key/path pairs)
+"""
+
+__author__ = "Scott Wallace"
+__version__ = "0.1"
+__maintainer__ = "Scott Wallace"
+__email__ = "scott@wallace.sh"
+__status__ = "Production"
+
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import optparse
+import logging
+
+def entry(cachedir, key):
+    """Function to return the path of a key within the cache."""
+    return os.path.join(cachedir, key[:2], key)
+
+def checksum(path):
+    """Function to return the SHA-1 hex digest of a file's content."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(1048576), ""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def present(cachedir, key):
+    """
+    Function to check an entry exists and still matches its key, removing
+    it if its content has changed so that it's sent again.
+    """
+    path = entry(cachedir, key)
+    try:
+        (digest, size, mode) = key.split(".")
+        stat = os.stat(path)
+    except (ValueError, OSError):
+        return False
+
+    if stat.st_size != int(size) or (stat.st_mode & 07777) != int(mode, 8):
+        return False
+
+    try:
+        if checksum(path) == digest:
+            return True
+    except IOError:
+        return False
+
+    logging.debug("Removing %s, changed since it was cached", path)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    return False
+
+def query(cachedir, keys):
+    """Function to write out each of the keys that are in the cache."""
+    for key in keys:
+        if present(cachedir, key):
+            sys.stdout.write("%s\n" % key)
+
+def link(cachedir, destination, pairs):
+    """
+    Function to materialise cache entries at the given paths under the
+    destination.  An empty key creates a directory.
+    """
+    for (key, path) in pairs:
+        target = os.path.join(destination, path)
+
+        if not key:
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            continue
+
+        source = entry(cachedir, key)
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Replace rather than write through an existing file
+        try:
+            os.unlink(target)
+        except OSError, errormessage:
+            if errormessage.errno != errno.ENOENT:
+                raise
+
+        try:
+            os.link(source, target)
+        except OSError:
+            # Different filesystem, most likely
+            shutil.copy2(source, target)
+
+        # Mark the entry as recently used
+        os.utime(source, None)
+
+def evict(cachedir, limit):
+    """Function to remove the least recently used entries above the limit."""
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(cachedir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    entries.sort()
+    while entries and total > limit:
+        (_, size, path) = entries.pop(0)
+        logging.debug("Evicting %s", path)
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+def main():
+    """Function to act as the main loop."""
+    cliopts = optparse.OptionParser()
+    cliopts.add_option(
+        "-c",
+        "--cache",
+        dest="cachedir",
+        help="The cache directory"
+    )
+    cliopts.add_option(
+        "-d",
+        "--destination",
+        dest="destination",
+        help="Destination directory to materialise the cached files into"
+    )
+    cliopts.add_option(
+        "-s",
+        "--size",
+        dest="size",
+        type="int",
+        help="Maximum size of the cache in megabytes"
+    )
+    (options, args) = cliopts.parse_args()
+
+    if options.cachedir is None or args not in (["query"], ["link"]):
+        cliopts.print_help()
+        sys.exit(1)
+
+    # Input is NUL separated
+    fields = sys.stdin.read().split("\0")
+    if fields and not fields[-1]:
+        fields.pop()
+
+    if args[0] == "query":
+        query(options.cachedir, fields)
+    else:
+        if options.destination is None:
+            cliopts.print_help()
+            sys.exit(1)
+        link(options.cachedir, options.destination, zip(fields[0::2], fields[1::2]))
+
+    if options.size is not None:
+        evict(options.cachedir, options.size * 1048576)
+
+    return True
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
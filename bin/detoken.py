@@ -12,11 +12,172 @@ __email__ = "scott@wallace.sh"
 __status__ = "Production"
 
 import os
+import re
 import sys
+import mmap
 import optparse
+import multiprocessing
 import shutil
 import logging
 
+# A token is an "@" delimited name that does not span lines
+TOKEN_RE = re.compile(r"@([^@\r\n]*)@")
+
+# Files larger than this are memory mapped rather than read in whole
+MMAP_THRESHOLD = 1048576
+
+# A NUL byte in this much of the start of a file marks it as binary, as grep(1)
+BINARY_SCAN = 8192
+
+def pieces(text, lookup):
+    """
+    Function to yield the text a piece at a time with every @TOKEN@ replaced,
+    in a single pass.  The lookup function returns the value for a token name
+    or None if it isn't a token, in which case the closing "@" is free to open
+    the next token.  The text may be a string or a memory map.
+    """
+    position = 0
+    match = TOKEN_RE.search(text, position)
+    while match:
+        value = lookup(match.group(1))
+        if value is None:
+            yield text[position:match.end() - 1]
+            position = match.end() - 1
+        else:
+            yield text[position:match.start()]
+            yield value
+            position = match.end()
+        match = TOKEN_RE.search(text, position)
+    yield text[position:]
+
+def substitute(text, lookup):
+    """
+    Function to replace every @TOKEN@ in the text in a single pass.
+    """
+    if "@" not in text:
+        return text
+
+    return "".join(pieces(text, lookup))
+
+def render(infile, outfile, lookup):
+    """
+    Function to write a detokenised copy of a template.  Binary files and files
+    without an "@" are copied unchanged, and large files are memory mapped and
+    written out a piece at a time rather than held in memory as strings.
+
+    Returns: How the file was handled, for logging
+    """
+    size = os.path.getsize(infile)
+
+    indata = open(infile, "rb")
+    output = open(outfile, "wb")
+    try:
+        if size == 0:
+            return "empty"
+
+        if size <= MMAP_THRESHOLD:
+            text = indata.read()
+            if "\0" in text[:BINARY_SCAN]:
+                output.write(text)
+                return "binary"
+            if "@" not in text:
+                output.write(text)
+                return "copied"
+            output.write(substitute(text, lookup))
+            return "substituted"
+
+        # Python 2 has no sendfile() for file to file copies, so large files
+        # are written straight from the page cache through a memory map
+        text = mmap.mmap(indata.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if text.find("\0", 0, BINARY_SCAN) != -1:
+                output.write(text)
+                return "binary"
+            if text.find("@") == -1:
+                output.write(text)
+                return "copied"
+            # Written in blocks to bound the memory used
+            block = []
+            blocksize = 0
+            for piece in pieces(text, lookup):
+                block.append(piece)
+                blocksize += len(piece)
+                if blocksize >= MMAP_THRESHOLD:
+                    output.write("".join(block))
+                    block = []
+                    blocksize = 0
+            output.write("".join(block))
+            return "substituted"
+        finally:
+            text.close()
+    finally:
+        indata.close()
+        output.close()
+
+def resolve(values):
+    """
+    Function to expand any tokens nested within the values themselves so that
+    templates need only a single substitution pass.  Circular references are
+    reported and left unexpanded.
+    """
+    resolved = {}
+
+    def resolve_key(key, chain):
+        if key in resolved:
+            return resolved[key]
+        if key in chain:
+            logging.warning(
+                "Circular token reference: %s",
+                " -> ".join(chain[chain.index(key):] + [key])
+            )
+            return None
+
+        chain.append(key)
+        value = substitute(
+            values[key],
+            lambda token: resolve_key(token, chain) if token in values else None
+        )
+        chain.pop()
+
+        resolved[key] = value
+        return value
+
+    for key in values:
+        resolve_key(key, [])
+
+    return resolved
+
+# The resolved properties, set before the workers are forked
+VALUES = {}
+
+def process(job):
+    """
+    Function to detokenise a single template into its directory, as a tuple
+    (template, directory, filename).
+
+    Returns: An error message, or None
+    """
+    (infile, target_directory, filename) = job
+
+    outfile = os.path.join(target_directory, filename)
+    logging.debug("Writing to %s", outfile)
+
+    # Write alongside and rename over the target so that an existing file,
+    # which may be hard linked elsewhere, is replaced rather than written
+    # through
+    tmpfile = os.path.join(target_directory, ".%s.detoken" % filename)
+    try:
+        handling = render(infile, tmpfile, VALUES.get)
+        logging.debug("%s: %s", infile, handling)
+
+        logging.debug("Copying from %s to %s", infile, outfile)
+        shutil.copymode(infile, tmpfile)
+        os.rename(tmpfile, outfile)
+    except (IOError, OSError), errormessage:
+        return "Could not detokenise %s: %s" % (infile, errormessage)
+
+    return None
+
 def main():
     """Function to act as the main loop."""
     # Set log level
@@ -44,6 +205,14 @@ def main():
         dest="destination",
         help="Destination directory to write the final configuration tree"
     )
+    cliopts.add_option(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type="int",
+        default=1,
+        help="Number of files to detokenise at once, in separate processes"
+    )
     (options, _) = cliopts.parse_args()
 
     # Ensure the required CLI options are provided
@@ -57,7 +226,8 @@ def main():
         logging.debug("Parsing configuration file: %s", options.configfile)
         config = open(options.configfile)
     except IOError, errormessage:
-        logging.warning(errormessage)
+        logging.error(errormessage)
+        sys.exit(1)
 
     for line in config:
         try:
@@ -71,80 +241,64 @@ def main():
         except ValueError:
             # Ignore "dodgy" lines
             logging.debug("Could not parse line: %s", line)
+    config.close()
+
+    # Expand nested tokens once, up front
+    values = resolve(values)
 
-    # Traverse the tree
+    # Shared with the workers when they're forked, rather than sent with each file
+    global VALUES
+    VALUES = values
+
+    # Traverse the tree, creating the directories up front so the workers
+    # need only write files
+    jobs = []
     for dirpath, dirnames, filenames in os.walk(options.templates):
         # Ignore SVN directories
         if ".svn" in dirnames:
             logging.debug("Ignoring .svn directory")
             dirnames.remove(".svn")
 
-        # Iterate over the files
-        for filename in filenames:
-            logging.debug("Working on %s", filename)
-            # Extract the relative path for use later
-            relativepath = dirpath[(len(options.templates)+1):]
+        if not filenames:
+            continue
 
-            infile = os.path.join(dirpath, filename)
-            indata = open(infile)
+        # Extract the relative path for use later
+        relativepath = dirpath[(len(options.templates)+1):]
 
-            # Create the directory for the output file
-            target_directory = os.path.join(options.destination, relativepath)
+        # Create the directory for the output files
+        target_directory = os.path.join(options.destination, relativepath)
+        try:
+            os.stat(target_directory)
+        except OSError:
             try:
-                os.stat(target_directory)
+                os.makedirs(target_directory)
             except OSError:
-                try:
-                    os.makedirs(target_directory)
-                except OSError:
-                    # Ignore mkdir errors
-                    logging.warning(
-                        "Could not make directory: %s",
-                        target_directory
-                    )
-
-            outfile = os.path.join(options.destination, relativepath, filename)
-            logging.debug("Writing to %s", outfile)
-            try:
-                output = open(outfile, "w")
-            except IOError, errormessage:
-                logging.error(
-                    "Could not open a file for writing: %s",
-                    errormessage
+                # Ignore mkdir errors
+                logging.warning(
+                    "Could not make directory: %s",
+                    target_directory
                 )
-                sys.exit(2)
-
-            # Iterate over the input file
-            for line in indata:
-                newline = line
-
-                # Create a loop where tokens keep substituting until the line
-                # doesn't change. Allows for nested tokens.
-                replaced = 1
-                while replaced == 1:
-                    replaced = 0
-                    # Find all the tokens in a line
-                    for token in values.keys():
-                        logging.debug(
-                            "Replacing \"%s\" with \"%s\"", token, values[token]
-                        )
-                        newline = line.replace("@%s@" % token, values[token])
-
-                        # Compare the lines, if different start the loop for the
-                        # line again
-                        if newline != line:
-                            logging.debug("Line has changed.  Rechecking.")
-                            line = newline
-                            replaced = 1
-                            break
-
-                # Write the final substituted line to the output file
-                output.write(newline)
-
-            indata.close()
-            output.close()
-
-            logging.debug("Copying from %s to %s", infile, outfile)
-            shutil.copymode(infile, outfile)
+
+        for filename in filenames:
+            jobs.append((os.path.join(dirpath, filename), target_directory, filename))
+
+    if options.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)))
+        try:
+            results = pool.imap_unordered(process, jobs, chunksize=16)
+            errors = [error for error in results if error is not None]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [error for error in map(process, jobs) if error is not None]
+
+    # Report every failure, not just the first
+    for error in errors:
+        logging.error(error)
+    if errors:
+        sys.exit(2)
+
     return True
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+A simple script runner for remote hosts.  Runs every executable file in a
+directory in sorted order and frames each script's output with start and end
+markers, carrying the exit code and timing, so that a whole script phase can be
+reported on over a single channel.
+"""
+
+__author__ = "Scott Wallace"
+__version__ = "0.1"
+__maintainer__ = "Scott Wallace"
+__email__ = "scott@wallace.sh"
+__status__ = "Production"
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import shutil
+import optparse
+import tempfile
+import subprocess
+import ConfigParser
+
+# Marks the lines written by the runner itself rather than by a script
+FRAME = "@@BOSS@@"
+
+# Declares which scripts in a directory may run alongside each other
+MANIFEST = ".boss-depends"
+
+def frame(*fields):
+    """Function to write a single framing line."""
+    sys.stdout.write("%s %s\n" % (FRAME, " ".join(str(field) for field in fields)))
+    sys.stdout.flush()
+
+def load_depends(scriptdir):
+    """
+    Function to read the [DEPENDS] section of a script directory's manifest,
+    each line naming a script and the scripts it must wait for, e.g.
+
+        [DEPENDS]
+        20-warm-cache = 10-install
+        30-logrotate =
+
+    Returns: A dictionary of script names to lists of script names
+    """
+    path = os.path.join(scriptdir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str
+    config.read(path)
+    if not config.has_section("DEPENDS"):
+        return {}
+
+    return dict(
+        (name, [depend.strip() for depend in value.split(",") if depend.strip()])
+        for (name, value) in config.items("DEPENDS")
+    )
+
+def schedule(names, depends):
+    """
+    Function to work out what each script waits for.  A script named in the
+    manifest waits for its dependencies and the last unnamed script before it.
+    An unnamed script waits for everything before it, and so keeps its place
+    in the sorted order as a barrier.
+
+    Returns: A dictionary of script names to sets of script names
+    """
+    waits = {}
+    barrier = None
+    since = []
+    for name in names:
+        if name in depends:
+            wait = set()
+            for depend in depends[name]:
+                if depend in names:
+                    wait.add(depend)
+                else:
+                    sys.stdout.write("%s: no such script %s\n" % (name, depend))
+            since.append(name)
+        else:
+            wait = set(since)
+            since = []
+        if barrier is not None:
+            wait.add(barrier)
+        if name not in depends:
+            barrier = name
+        waits[name] = wait
+
+    return waits
+
+def passthrough(process):
+    """
+    Function to copy a script's output to stdout as it arrives, until the
+    script itself exits.  Whatever it left in the pipe is passed on, but
+    background processes it started and that still hold the pipe open aren't
+    waited for.
+
+    Returns: A tuple (last byte written or an empty string, wait() status)
+    """
+    fd = process.stdout.fileno()
+    last = ""
+    status = None
+    eof = False
+    while status is None:
+        (readable, writable, errors) = select.select([fd], [], [], 0.1)
+        if readable:
+            data = os.read(fd, 65536)
+            if not data:
+                # Nothing holds the pipe open any more, so the script is done
+                eof = True
+                status = os.waitpid(process.pid, 0)[1]
+                break
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            last = data[-1]
+
+        (pid, result) = os.waitpid(process.pid, os.WNOHANG)
+        if pid:
+            status = result
+
+    # Drain what's already there without waiting on anything still writing
+    if not eof:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            last = data[-1]
+    process.stdout.close()
+
+    return (last, status)
+
+def exitstatus(status):
+    """Function to decode a wait() status as subprocess does."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def main():
+    """Function to act as the main loop."""
+    parser = optparse.OptionParser(usage="%prog [-j N] <script directory>")
+    parser.add_option(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type="int",
+        default=1,
+        help="Number of scripts to run at once, as their dependencies allow"
+    )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+
+    scriptdir = args[0]
+
+    names = [name for name in sorted(os.listdir(scriptdir))
+             if name != MANIFEST and os.path.isfile(os.path.join(scriptdir, name))]
+    waits = schedule(names, load_depends(scriptdir))
+
+    # Output is passed through as it arrives when scripts run one at a time,
+    # but held back until each finishes when they don't, so it isn't
+    # interleaved
+    buffered = options.jobs > 1
+
+    pending = list(names)
+    done = set()
+    running = {}
+    while pending or running:
+        for name in list(pending):
+            if len(running) >= options.jobs:
+                break
+            if not waits[name] <= done:
+                continue
+            pending.remove(name)
+
+            script = os.path.join(scriptdir, name)
+
+            # Non-executable scripts are "disabled"
+            if not os.access(script, os.X_OK):
+                frame("SKIP", name)
+                done.add(name)
+                continue
+
+            if not buffered:
+                frame("START", name)
+            output = tempfile.TemporaryFile() if buffered else None
+            started = time.time()
+            try:
+                process = subprocess.Popen([script], stdout=output or subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError, errormessage:
+                if buffered:
+                    frame("START", name)
+                sys.stdout.write("%s\n" % errormessage)
+                frame("END", 127, "%.3f" % (time.time() - started), name)
+                done.add(name)
+                continue
+
+            # Only one script runs at a time, so it can be seen through here
+            if not buffered:
+                (last, status) = passthrough(process)
+                process.returncode = exitstatus(status)
+                if last not in ("", "\n"):
+                    sys.stdout.write("\n")
+                frame("END", process.returncode, "%.3f" % (time.time() - started), name)
+                done.add(name)
+                continue
+
+            running[process.pid] = (name, process, output, started)
+
+        if not running:
+            if not pending:
+                break
+
+            # Nothing can start, so the first script left is part of a cycle;
+            # fail it to let the rest go on
+            name = pending.pop(0)
+            frame("START", name)
+            sys.stdout.write("Circular dependency: %s waits for %s\n" % (name, ", ".join(sorted(waits[name] - done))))
+            frame("END", 1, "0.000", name)
+            done.add(name)
+            continue
+
+        (pid, status) = os.wait()
+        if pid not in running:
+            continue
+        (name, process, output, started) = running.pop(pid)
+        seconds = time.time() - started
+
+        # Reaped here rather than by subprocess
+        process.returncode = exitstatus(status)
+
+        frame("START", name)
+        output.seek(0)
+        shutil.copyfileobj(output, sys.stdout)
+
+        # Keep the end marker on a line of its own
+        size = output.tell()
+        if size:
+            output.seek(size - 1)
+            if output.read(1) != "\n":
+                sys.stdout.write("\n")
+        output.close()
+        frame("END", process.returncode, "%.3f" % seconds, name)
+        done.add(name)
+
+    return True
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
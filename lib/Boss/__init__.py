@@ -14,3 +14,11 @@ sys.path.append(os.path.join(__install__, "lib", "paramiko"))
 
 from server import *
 from client import *
+from session import *
+from report import *
+from connection import *
+from inventory import *
+from hashindex import *
+from compression import *
+from logsink import *
+from daemon import *
@@ -1,53 +1,149 @@
 import os
 import sys
+import stat
+import pipes
 import random
 import string
+import hashlib
+import tarfile
+import logging
 import paramiko
 import Boss
 
-class IgnoreMissingKeys(paramiko.MissingHostKeyPolicy):
+# Marks the framing lines written by bin/runner.py
+RUNNER_FRAME = "@@BOSS@@"
+
+def filehash(path):
+    """
+    Function to return the SHA-1 hex digest of a local file's content.
+    """
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(1048576), ""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+class countingfile():
+    """
+    Class to count the bytes written through a file-like object.
     """
-    Class to set up a policy to ignote missing SSH host keys.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+class hostlog(logging.LoggerAdapter):
     """
+    Class to tag log records with the name of the host they relate to and, unless told not to, to
+    prefix every line of the message with it.
+    """
+
+    def __init__(self, logger, extra, prefix=True):
+        logging.LoggerAdapter.__init__(self, logger, extra)
+        self.prefix = prefix
 
-    def missing_host_key(self, client, hostname, key):
+    def process(self, msg, kwargs):
         """
-        Class method to handle missing host keys.
+        Class method to add the host to a log record and the host prefix to its message.
         """
 
-        # Do nothing; i.e. ignore.
-        return
+        kwargs["extra"] = self.extra
+        if not self.prefix:
+            return msg, kwargs
+
+        prefix = "[{0}] ".format(self.extra["host"])
+        return "\n".join(prefix + line for line in str(msg).split("\n")), kwargs
+
+    # Match the logger interface used elsewhere
+    warn = logging.LoggerAdapter.warning
 
 class client():
     """
-    Class for a remote BOSS client.
+    Class for a remote BOSS client.  Close it, or use it in a with statement, to tidy up on the remote
+    host and hand back its transport.
     """
 
     tmpdir = "/tmp"
     deployroot = "/"
-
-    def __init__(self, hostname, username):
-        # Set up an SSH client and set the key policy to ignore missing keys
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        missingKeyPolicy = IgnoreMissingKeys()
-        self.client.set_missing_host_key_policy(missingKeyPolicy)
+    log = Boss.bosslog
+    envlist = None
+    hostvars = {}
+    rendered = None
+    helpers = None
+    remotecache = None
+    remotecachesize = None
+    transfermode = "sftp"
+    deltadelete = False
+
+    # The number of templates to detokenise at once on the remote host
+    detokenjobs = 1
+
+    # The number of scripts to run at once, as their dependencies allow
+    scriptjobs = 1
+
+    # Files of at least this many bytes are sent in chunks over several SFTP channels at once
+    largefile = 33554432
+    chunksize = 8388608
+    channels = 4
+
+    # A (path, checksum) of a pkg/ archive already sent to the host by relay
+    payload = None
+
+    # The name of the release directory to build, when deploying releases, and how many to keep
+    release = None
+    keepreleases = 5
+    manifestname = ".boss-manifest"
+
+    # A Boss.hashindex to take the checksums of local files from
+    hashes = None
+
+    # A Boss.compression policy for what's sent, or None to send everything as it is
+    compression = None
+
+    def __init__(self, hostname, username, keyfile=None, report=None, connections=None, timeouts=None):
+        # Share transports through the connection manager, or use one of our own
+        self.owned = connections is None
+        if self.owned:
+            connections = Boss.connections()
+        self.connections = connections
 
         # Set some object attributes
         self.hostname = hostname
         self.username = username
-
-        # Connect to the remote host
-        try:
-            self.client.connect(hostname, username=username)
-        except Exception, e:
-            raise Exception("There was a problem connecting to {0}@{1}: {2}".format(username, hostname, e))
+        self.report = report
+        self.sent = 0
+        self.saved = 0
+        self.transport = None
+        self.sftp = None
+        self.remote_basedir = None
+        self.closed = False
+
+        # Connect to the remote host, or reuse an existing connection
+        with self.timer("connect"):
+            try:
+                self.transport = self.connections.get(hostname, username, keyfile, timeouts)
+            except Exception, e:
+                self.close()
+                raise Exception("There was a problem connecting to {0}@{1}: {2}".format(username, hostname, e))
 
         # Generate a random string to avoid problems/conflicts
         rndstring = "".join(random.choice(string.ascii_uppercase + string.digits) for x in range(16))
 
         self.remote_basedir = os.path.join(self.tmpdir, "BOSS-{0}".format(rndstring))
-        self.mkdirs(self.remote_basedir)
+        try:
+            self.mkdirs(self.remote_basedir)
+        except Exception:
+            self.close()
+            raise
 
     def buildVarlist(self):
         """
@@ -59,6 +155,11 @@ class client():
         varlist["ENVIRONMENT"] = self.environment
         varlist["PROJECT"] = self.project
         varlist["CONTEXT"] = self.context
+        if self.release is not None:
+            varlist["RELEASE"] = self.deployroot
+
+        # Describe the host from the inventory
+        varlist.update(self.hostvars)
 
         # Set any additional variable mappings
         for name, value in self.varmap.iteritems():
@@ -70,7 +171,7 @@ class client():
         # Build a single string
         envlist = ""
         for name, value in varlist.iteritems():
-            envlist = "{0} {1}={2}".format(envlist, name, value)
+            envlist = "{0} {1}={2}".format(envlist, name, pipes.quote(str(value)))
 
         return envlist
 
@@ -79,7 +180,10 @@ class client():
         Class method to recursively make directories on a remote client.
         """
 
-        for line in self.execute("mkdir -p {0}".format(directory)): pass
+        result = self.execute("mkdir -p {0}".format(directory))
+        output = [line for line in result]
+        if result.status != 0:
+            raise Exception("Could not create directory {0}: {1}".format(directory, " ".join(output)))
 
     def rmdirs(self, directory):
         """
@@ -88,39 +192,335 @@ class client():
 
         for line in self.execute("rm -rf {0}".format(directory)): pass
 
-    def pushDirectory(self, src_dir, dst_dir):
+    def pushDirectory(self, src_dir, dst_dir, fresh=False, label=None):
         """
-        Class method to copy the contents of a directory to a remote host.
+        Class method to copy the contents of a directory to a remote host.  A fresh destination is
+        known to be empty, so there's nothing to gain from comparing it with the local copy.  The label
+        names the record kept by delta transfers, so that several trees can share a destination, and
+        defaults to the name of the source directory.
+        """
+
+        label = label or os.path.basename(src_dir)
+
+        with self.timer("push", label) as timing:
+            sent = self.sent
+            saved = self.saved
+
+            if self.remotecache is not None:
+                self.pushCached(src_dir, dst_dir)
+            elif self.transfermode == "archive":
+                self.pushArchive(src_dir, dst_dir)
+            elif (self.transfermode == "delta" or self.release is not None) and not fresh:
+                self.pushDelta(src_dir, dst_dir, label)
+            else:
+                self.pushFiles(src_dir, dst_dir)
+
+            timing.bytes = self.sent - sent
+            timing.saved = self.saved - saved
+
+    def pushFiles(self, src_dir, dst_dir):
+        """
+        Class method to copy the contents of a directory to a remote host file by file.
         """
 
         self.mkdirs(dst_dir)
 
-        sftp = self.client.open_sftp()
+        sftp = self.getSftp()
 
         # Count how many directories deep so we can avoid sending too deep
         pathskip = len(src_dir.split(os.sep))
 
         # Recurse the local directory and copy its content to the remote host
+        paths = []
         for dirname, dirs, files in os.walk(src_dir):
             shortdir = os.sep.join(dirname.split(os.sep)[pathskip:])
             self.mkdirs(os.path.join(dst_dir, shortdir))
+            for file in files:
+                paths.append(os.path.join(shortdir, file))
+
+        self.putFiles(sftp, src_dir, dst_dir, paths)
+
+    def putFiles(self, sftp, src_dir, dst_dir, paths):
+        """
+        Class method to copy files, given relative to a local directory, to a remote host.  Those the
+        compression policy picks a level for travel together as a compressed archive, one for each
+        level, and the rest go over the open SFTP session.
+        """
+
+        batches = {}
+        for path in paths:
+            local_file = os.path.join(src_dir, path)
+
+            # Large files keep to their resumable transfer
+            level = self.compressLevel([local_file])
+            if level and os.stat(local_file).st_size < self.largefile:
+                batches.setdefault(level, []).append(path)
+            else:
+                self.putFile(sftp, local_file, os.path.join(dst_dir, path))
+
+        for level, batch in sorted(batches.iteritems()):
+            send = self.archiver([(os.path.join(src_dir, path), path) for path in batch], level)
+            (status, output) = self.capture("tar --no-same-owner -x{0}pf - -C {1} 2>&1".format("z" if level else "", dst_dir), send)
+            if status != 0:
+                raise Exception("Compressed transfer to {0} failed: {1}".format(dst_dir, output.strip()))
+
+    def putFile(self, sftp, local_file, remote_file):
+        """
+        Class method to copy a single file to a remote host, with its permissions, over an open SFTP
+        session.  Large files go over several channels instead.
+        """
+
+        lstat = os.stat(local_file)
+
+        try:
+            if lstat.st_size >= self.largefile:
+                self.putLarge(local_file, remote_file)
+                return
+
+            # Copy and duplicate permissions
+            sftp.put(local_file, remote_file)
+        except Exception, e:
+            raise Exception("File copy failed: {0}: {1}".format(remote_file, e))
+
+        sftp.chmod(remote_file, lstat.st_mode)
+        self.sent += lstat.st_size
+
+    def putLarge(self, local_file, remote_file):
+        """
+        Class method to copy a large file to a remote host in chunks, several at once over separate
+        SFTP channels with pipelined writes.  The chunks are written to a partial file alongside the
+        target, so an interrupted copy resumes with only the chunks whose checksums don't already
+        match.  The whole file's checksum is verified on the remote host before it's moved into place.
+        """
+
+        lstat = os.stat(local_file)
+        partfile = "{0}.boss-part".format(remote_file)
+
+        # Checksum each chunk, and the whole file, locally
+        digest = hashlib.sha1()
+        checksums = []
+        with open(local_file, "rb") as infile:
+            for chunk in iter(lambda: infile.read(self.chunksize), ""):
+                digest.update(chunk)
+                checksums.append(hashlib.sha1(chunk).hexdigest())
+
+        # And those of any chunks already sent
+        (status, output) = self.capture("mkdir -p {0} && touch {1} && size=$(wc -c < {1}) && i=0 && "
+                                        "while [ $((i * {2})) -lt $size ]; do dd if={1} bs={2} skip=$i count=1 2>/dev/null | sha1sum; i=$((i + 1)); done".format(
+                                        os.path.dirname(remote_file), partfile, self.chunksize))
+        if status != 0:
+            raise Exception("Could not create {0}: {1}".format(partfile, output.strip()))
+        sent = [line[:40] for line in output.splitlines()]
+
+        pending = [index for (index, checksum) in enumerate(checksums) if index >= len(sent) or sent[index] != checksum]
+        if len(pending) < len(checksums):
+            self.log.info("| {0}: resuming, {1} of {2} chunks to send".format(os.path.basename(remote_file), len(pending), len(checksums)))
+
+        counts = {}
+
+        def send(indexes):
+            count = 0
+            sftp = self.openSftp()
+            try:
+                outfile = sftp.open(partfile, "r+b")
+                outfile.set_pipelined(True)
+                with open(local_file, "rb") as infile:
+                    for index in indexes:
+                        infile.seek(index * self.chunksize)
+                        outfile.seek(index * self.chunksize)
+                        remaining = self.chunksize
+                        while remaining > 0:
+                            block = infile.read(min(remaining, 32768))
+                            if not block:
+                                break
+                            outfile.write(block)
+                            remaining -= len(block)
+                            count += len(block)
+                # Waits for the outstanding writes to be acknowledged
+                outfile.close()
+            finally:
+                sftp.close()
+                counts[indexes] = count
+
+        # Spread the chunks between the channels
+        groups = [tuple(pending[start::self.channels]) for start in range(min(self.channels, len(pending)))]
+        results = Boss.concurrently(send, groups, len(groups))
+        self.sent += sum(counts.values())
+        for group in groups:
+            if results[group] is not None:
+                raise results[group]
+
+        # Trim anything beyond the end, check the whole and move it into place
+        (status, output) = self.capture("truncate -s {0} {1} && [ \"$(sha1sum < {1} | cut -c1-40)\" = {2} ] && chmod {3:o} {1} && mv -f {1} {4} || {{ rm -f {1}; exit 1; }}".format(
+                                        lstat.st_size, partfile, digest.hexdigest(), stat.S_IMODE(lstat.st_mode), remote_file))
+        if status != 0:
+            raise Exception("Checksum mismatch after copying {0}: {1}".format(remote_file, output.strip()))
+
+    def pushArchive(self, src_dir, dst_dir):
+        """
+        Class method to stream the contents of a directory to a remote host as a single tar archive,
+        unpacking it on the fly and keeping the file modes.
+        """
+
+        files = [os.path.join(dirname, file) for dirname, dirs, filenames in os.walk(src_dir) for file in filenames]
+        level = self.compressLevel(files)
+
+        # Only the directory's contents, so dst_dir itself keeps the mode it already has
+        send = self.archiver([(os.path.join(src_dir, name), name) for name in sorted(os.listdir(src_dir))], level)
+        (status, output) = self.capture("mkdir -p {0} && tar --no-same-owner -x{1}pf - -C {0} 2>&1".format(dst_dir, "z" if level else ""), send)
+        if status != 0:
+            raise Exception("Archive transfer to {0} failed: {1}".format(dst_dir, output.strip()))
+
+    def pushCached(self, src_dir, dst_dir):
+        """
+        Class method to materialise the contents of a directory on a remote host from its persistent
+        cache, sending only the files the cache doesn't already hold.
+        """
+
+        helper = self.helper("cache.py")
+
+        # Cache entries are keyed on content, size and mode
+        if self.hashes is not None:
+            (directories, files) = self.hashes.tree(src_dir)
+        else:
+            (directories, manifest) = self.localManifest(src_dir)
+            files = {}
+            for path, checksum in manifest.iteritems():
+                lstat = os.stat(os.path.join(src_dir, path))
+                files[path] = (checksum, lstat.st_size, lstat.st_mode & 07777)
+
+        keys = {}
+        for path, (checksum, size, mode) in files.iteritems():
+            keys[path] = "{0}.{1}.{2:o}".format(checksum, size, mode)
+
+        (status, output) = self.capture("{0} -c {1} query".format(helper, self.remotecache), "".join("{0}\0".format(key) for key in set(keys.values())))
+        if status != 0:
+            raise Exception("Could not query the remote cache {0}: exit code {1}".format(self.remotecache, status))
+
+        cached = set(output.split())
+        missing = dict((key, path) for path, key in keys.iteritems() if key not in cached)
+
+        self.log.info("| {0}: {1} cached, {2} to send".format(os.path.basename(src_dir), len(keys) - len(missing), len(missing)))
+
+        # Send what's missing straight into the cache
+        if missing:
+            members = [(os.path.join(src_dir, path), os.path.join(key[:2], key)) for key, path in sorted(missing.iteritems())]
+            level = self.compressLevel([local_file for (local_file, arcname) in members])
+
+            send = self.archiver(members, level)
+            (status, output) = self.capture("mkdir -p {0} && tar --no-same-owner -x{1}pf - -C {0} 2>&1".format(self.remotecache, "z" if level else ""), send)
+            if status != 0:
+                raise Exception("Could not send files to the remote cache {0}: {1}".format(self.remotecache, output.strip()))
+
+        # Link everything into place, keeping the cache within its limit
+        pairs = ["\0{0}\0".format(directory) for directory in directories]
+        pairs.extend("{0}\0{1}\0".format(keys[path], path) for path in sorted(keys))
+
+        size = ""
+        if self.remotecachesize is not None:
+            size = " -s {0}".format(self.remotecachesize)
+
+        (status, output) = self.capture("{0} -c {1} -d {2}{3} link 2>&1".format(helper, self.remotecache, dst_dir, size), "".join(pairs))
+        if status != 0:
+            raise Exception("Could not link files from the remote cache into {0}: {1}".format(dst_dir, output.strip()))
+
+    def localManifest(self, src_dir):
+        """
+        Class method to build a manifest of a local directory.
+
+        Returns: A tuple (directories, files) of relative paths, files mapped to their checksums
+        """
+
+        if self.hashes is not None:
+            return self.hashes.manifest(src_dir)
+
+        directories = []
+        manifest = {}
+        for dirname, dirs, files in os.walk(src_dir):
+            directories.append(os.path.relpath(dirname, src_dir))
             for file in files:
                 local_file = os.path.join(dirname, file)
-                remote_file = os.path.join(dst_dir, shortdir, file)
+                manifest[os.path.relpath(local_file, src_dir)] = filehash(local_file)
 
-                # Copy and duplicate permissions
-                try:
-                    sftp.put(local_file, remote_file)
-                except Exception, e:
-                    raise Exception("File copy failed: {0}: {1}".format(remote_file, e))
+        return (directories, manifest)
 
-                sftp.chmod(remote_file, os.stat(local_file).st_mode)
+    def remoteManifest(self, dst_dir, paths, manifestfile):
+        """
+        Class method to checksum, in a single round trip, the given relative paths plus those listed
+        in the manifest file of the last delta transfer to a remote directory.
+
+        Returns: A dictionary of the relative paths that exist remotely mapped to their checksums
+        """
 
-        sftp.close()
+        command = ("cd {0} 2>/dev/null || {{ cat >/dev/null; exit 0; }}; "
+                   "(cat; cat {1} 2>/dev/null) | sort -u | "
+                   "while IFS= read -r f; do [ -f \"$f\" ] && printf '%s\\0' \"$f\"; done | "
+                   "xargs -0 -r sha1sum").format(dst_dir, manifestfile)
+
+        (status, output) = self.capture(command, "".join("{0}\n".format(path) for path in paths))
+        if status != 0:
+            raise Exception("Could not build a manifest of {0}: exit code {1}".format(dst_dir, status))
+
+        manifest = {}
+        for line in output.splitlines():
+            # sha1sum escapes awkward file names and marks the line with a leading backslash
+            if line.startswith("\\"):
+                line = line[1:].replace("\\\\", "\\")
+            manifest[line[42:]] = line[:40]
+
+        return manifest
+
+    def pushDelta(self, src_dir, dst_dir, label):
+        """
+        Class method to copy only the new or changed files in a local directory to a remote host.
+        """
+
+        manifestfile = "{0}.{1}".format(self.manifestname, label)
+
+        (directories, local) = self.localManifest(src_dir)
+        remote = self.remoteManifest(dst_dir, local.keys(), manifestfile)
+
+        changed = sorted(path for path in local if remote.get(path) != local[path])
+        stale = sorted(path for path in remote if path not in local)
+
+        self.log.info("| {0}: {1} changed, {2} unchanged, {3} removed".format(label, len(changed), len(local) - len(changed), len(stale)))
+
+        # Create the directory structure in one go
+        (status, output) = self.capture("mkdir -p {0} && cd {0} && xargs -0 mkdir -p".format(dst_dir), "".join("{0}\0".format(directory) for directory in directories))
+        if status != 0:
+            raise Exception("Could not create directories under {0}: {1}".format(dst_dir, output.strip()))
+
+        # A release starts out as hard links to the last one, which mustn't be written through
+        if self.release is not None:
+            (status, output) = self.capture("cd {0} && xargs -0 rm -f".format(dst_dir), "".join("{0}\0".format(path) for path in changed + [manifestfile]))
+            if status != 0:
+                raise Exception("Could not replace files under {0}: {1}".format(dst_dir, output.strip()))
+
+        sftp = self.getSftp()
+
+        self.putFiles(sftp, src_dir, dst_dir, changed)
+
+        # Tidy up, or report, the files that no longer exist locally
+        if stale:
+            if self.deltadelete or self.release is not None:
+                (status, output) = self.capture("cd {0} && xargs -0 rm -f".format(dst_dir), "".join("{0}\0".format(path) for path in stale))
+                if status != 0:
+                    self.log.warn("| Could not remove stale files under {0}: {1}".format(dst_dir, output.strip()))
+            else:
+                for path in stale:
+                    self.log.warn("| {0}: no longer part of the project.  Leaving in place.".format(os.path.join(dst_dir, path)))
+
+        # Record what was sent so later runs can spot removed files
+        manifest = sftp.open(os.path.join(dst_dir, manifestfile), "w")
+        manifest.write("".join("{0}\n".format(path) for path in sorted(local)))
+        manifest.close()
 
     def deploy(self, scriptdir=None):
         """
-        Class method to copy a local directory to a remote host and executes the scripts within.
+        Class method to copy a local directory to a remote host and executes the scripts within.  The
+        scripts and the runner travel as one archive and run over a single channel.
+
+        Returns: A list of tuples (script, errorcode, seconds)
         """
 
         # Default to the supplied project for the script directory
@@ -129,48 +529,74 @@ class client():
 
         # Warn if there's no scripts to run
         if not os.path.exists(scriptdir):
-            Boss.bosslog.warn("""The "{0}" script directory does not exist.""".format(scriptdir))
+            self.log.warn("""The "{0}" script directory does not exist.""".format(scriptdir))
             return False
 
-        # Build the remote path and sure it exists on the remote host
+        # Build the remote paths
         remotedir = os.path.join(self.remote_basedir, os.path.basename(scriptdir))
-        self.mkdirs(remotedir)
+        runner = os.path.join(self.remote_basedir, "runner.py")
+
+        # Build a list of the environment variables to pass through, once
+        if self.envlist is None:
+            self.envlist = self.buildVarlist()
+
+        # Scripts already in the remote cache needn't travel with the runner
+        if self.remotecache is not None:
+            self.pushCached(scriptdir, remotedir)
+
+        members = [(os.path.join(Boss.__install__, "bin", "runner.py"), "runner.py")]
+        for file in sorted(os.listdir(scriptdir)):
+            if self.remotecache is not None:
+                break
+            local_file = os.path.join(scriptdir, file)
+            if os.path.isfile(local_file):
+                members.append((local_file, os.path.join(os.path.basename(remotedir), file)))
 
-        # Build a list of the environment variables to pass through
-        envlist = self.buildVarlist()
+        level = self.compressLevel([local_file for (local_file, arcname) in members])
+        send = self.archiver(members, level)
 
-        # Create an SFTP channel for transferring files
-        sftp = self.client.open_sftp()
+        # Unpack, run and tidy up in one go
+        command = "mkdir -p {0} && tar --no-same-owner -x{5}pf - -C {0} && {1} {2} -j {4} {3}; status=$?; rm -rf {3}; exit $status".format(
+            self.remote_basedir, self.envlist, runner, remotedir, self.scriptjobs, "z" if level else "")
 
         # Output the directory name
-        Boss.bosslog.info("| {0}".format(os.path.basename(remotedir)))
-        for dirname, dirs, files in os.walk(scriptdir):
-            files.sort()
-            for file in files:
-                # Build paths to the local and remote files
-                local_file = os.path.join(scriptdir, file)
-                remote_file = os.path.join(remotedir, file)
-
-                # Check for execute permissions
-                if os.access(local_file, os.X_OK):
-                    # Copy the local file to the remote host
-                    sftp.put(local_file, remote_file)
-                else:
-                    # Warn about a non-executable script
-                    Boss.bosslog.warn("""| {0}: not executable.  Skipping.""".format(file))
-                    continue
-
-                # Get the file permissions from the local file and apply them remotely
-                lstat = os.stat(local_file)
-                sftp.chmod(remote_file, lstat.st_mode)
-
-                # Execute the remote script
-                Boss.bosslog.info("| | {0}".format(os.path.basename(remote_file)))
-                for line in self.execute("{0} {1}".format(envlist, remote_file)):
-                    Boss.bosslog.info("| | | {0}".format(line))
-
-        self.rmdirs(remotedir)
-        sftp.close()
+        self.log.info("| {0}".format(os.path.basename(remotedir)))
+
+        timing = self.timer("scripts", os.path.relpath(scriptdir, Boss.__install__))
+        sent = self.sent
+        saved = self.saved
+
+        results = []
+        phase = self.execute(command, send)
+        for line in phase:
+            if not line.startswith(RUNNER_FRAME):
+                self.log.info("| | | %s", line)
+                continue
+
+            fields = line.split(" ", 2)
+            if fields[1] == "START":
+                self.log.info("| | {0}".format(fields[2]))
+            elif fields[1] == "SKIP":
+                # Warn about a non-executable script
+                self.log.warn("""| {0}: not executable.  Skipping.""".format(fields[2]))
+            elif fields[1] == "END":
+                (status, seconds, script) = fields[2].split(" ", 2)
+                results.append((script, int(status), float(seconds)))
+                if self.report is not None:
+                    self.report.record(self.hostname, "script", script, float(seconds), status=int(status))
+                if int(status) != 0:
+                    self.log.warn("| | {0}: exit code {1}".format(script, status))
+
+        timing.bytes = self.sent - sent
+        timing.saved = self.saved - saved
+        timing.status = phase.status
+        timing.finish()
+
+        # The runner itself only fails if the scripts never made it
+        if phase.status != 0:
+            raise Exception("Could not run the scripts in {0}: exit code {1}".format(remotedir, phase.status))
+
+        return results
 
     def configure(self, root=None):
         """
@@ -181,61 +607,342 @@ class client():
         if root is not None:
             self.deployroot = root
 
+        # Build a new release alongside the current one
+        if self.release is not None:
+            self.prepareRelease()
+
         # Create a directory to perform the configuration detokenisation
         self.configroot = os.path.join(self.remote_basedir, ".configure")
 
-        self.pushDirectory(os.path.join(Boss.__install__, "projects", self.project, "templates"), os.path.join(self.configroot, "templates"))
-        self.pushDirectory(os.path.join(Boss.__install__, "projects", self.project, "conf"), os.path.join(self.configroot, "conf"))
+        # Templates rendered on the control node are sent by detoken()
+        if self.rendered is None:
+            self.pushDirectory(os.path.join(Boss.__install__, "projects", self.project, "templates"), os.path.join(self.configroot, "templates"), fresh=True)
+            self.pushDirectory(os.path.join(Boss.__install__, "projects", self.project, "conf"), os.path.join(self.configroot, "conf"), fresh=True)
+
+        # Unpack the payload passed on by a relay, if it made it here intact
+        if self.payload is not None:
+            (payload, checksum) = self.payload
+            with self.timer("push", "pkg") as timing:
+                (status, output) = self.capture("printf '%s  %s\\n' {0} {1} | sha1sum -c --status && mkdir -p {2} && tar --no-same-owner -xpf {1} -C {2}; status=$?; rm -rf {3}; exit $status".format(checksum, payload, self.deployroot, os.path.dirname(payload)))
+                timing.status = status
+
+            # Removed along the way, whether or not it was intact
+            self.payload = None
+            if status == 0:
+                return
+            self.log.warn("The relayed payload couldn't be unpacked, sending pkg/ directly")
+
         self.pushDirectory(os.path.join(Boss.__install__, "projects", self.project, "pkg"), os.path.join(self.deployroot))
 
+    def prepareRelease(self):
+        """
+        Class method to create a new release directory under the deployment root, made of hard links
+        to the files of the current release so that only changed files need sending, and deploy into
+        it from then on.
+        """
+
+        self.releaseroot = self.deployroot
+        self.deployroot = os.path.join(self.releaseroot, "releases", self.release)
+
+        # An archive from a relay replaces every file anyway
+        if self.payload is not None:
+            command = "rm -rf {1} && mkdir -p {1}"
+        else:
+            command = "rm -rf {1} && mkdir -p {0}/releases && if [ -d {0}/current/ ]; then cp -al {0}/current/. {1}; else mkdir -p {1}; fi"
+
+        # Never start over a release that's in use
+        command = "[ \"$(readlink {0}/current)\" != releases/{2} ] && " + command
+
+        (status, output) = self.capture(command.format(self.releaseroot, self.deployroot, self.release) + " 2>&1")
+        if status != 0:
+            raise Exception("Could not create the release directory {0}: {1}".format(self.deployroot, output.strip()))
+
+    def pruneRelease(self):
+        """
+        Class method to remove anything from the new release that the project no longer provides.  A
+        release starts out as a copy of the last one, and only delta transfers tidy up after
+        themselves, so this catches what archive transfers, the remote cache and remote
+        detokenisation leave behind.
+        """
+
+        # Everything the release should hold: pkg/ and the detokenised templates
+        templates = self.rendered or os.path.join(Boss.__install__, "projects", self.project, "templates")
+        expected = set()
+        for src_dir in (os.path.join(Boss.__install__, "projects", self.project, "pkg"), templates):
+            for dirname, dirs, files in os.walk(src_dir):
+                if ".svn" in dirs:
+                    dirs.remove(".svn")
+                for name in dirs + files:
+                    expected.add(os.path.relpath(os.path.join(dirname, name), src_dir))
+
+        (status, output) = self.capture("cd {0} && find . -mindepth 1 -printf '%P\\0'".format(self.deployroot))
+        if status != 0:
+            raise Exception("Could not list the release directory {0}: exit code {1}".format(self.deployroot, status))
+
+        stale = sorted(path for path in output.split("\0") if path and path not in expected and not os.path.basename(path).startswith(self.manifestname))
+
+        # Whole directories go in one, so skip anything beneath one already going
+        removing = []
+        for path in stale:
+            if not removing or not path.startswith(removing[-1] + os.sep):
+                removing.append(path)
+
+        if removing:
+            self.log.info("| Removing {0} paths no longer in the project from the release".format(len(removing)))
+            (status, output) = self.capture("cd {0} && xargs -0 rm -rf 2>&1".format(self.deployroot), "".join("{0}\0".format(path) for path in removing))
+            if status != 0:
+                raise Exception("Could not remove stale files from {0}: {1}".format(self.deployroot, output.strip()))
+
+    def activate(self):
+        """
+        Class method to point the "current" symlink at the new release, atomically, and remove all but
+        the most recent releases.
+        """
+
+        if self.release is None:
+            return
+
+        self.pruneRelease()
+
+        self.log.info("| Activating release {0}".format(self.release))
+
+        (status, output) = self.capture("cd {0} && ln -sfn releases/{1} .current.tmp && mv -Tf .current.tmp current && "
+                                        "ls -1 releases | sort | head -n -{2} | grep -vx {1} | sed 's,^,releases/,' | xargs -r rm -rf 2>&1".format(
+                                        self.releaseroot, self.release, self.keepreleases))
+        if status != 0:
+            raise Exception("Could not activate release {0}: {1}".format(self.release, output.strip()))
+
+    def rollback(self, root=None):
+        """
+        Class method to point the "current" symlink back at the release before it.
+
+        Returns: The name of the release now current
+        """
+
+        if root is not None:
+            self.deployroot = root
+
+        (status, output) = self.capture("cd {0} && target=$(readlink current) && "
+                                        "previous=$(ls -1 releases | sort | awk -v target=\"${{target##*/}}\" '$0 == target {{ print last; exit }} {{ last = $0 }}') && "
+                                        "[ -n \"$previous\" ] && ln -sfn releases/$previous .current.tmp && mv -Tf .current.tmp current && echo $previous".format(self.deployroot))
+        if status != 0:
+            raise Exception("There's no earlier release to roll back to under {0}".format(self.deployroot))
+
+        return output.strip()
+
     def detoken(self):
         """
         Class method to copy over the detokeniser and run it against any deployed configuration.
         """
 
-        # Copy over the lib/detoken.py script and set the permissions
-        sftp = self.client.open_sftp()
-        sftp.put(os.path.join(Boss.__install__, "bin", "detoken.py"), os.path.join(self.configroot, "detoken.py"))
-        sftp.chmod(os.path.join(self.configroot, "detoken.py"), 0755)
-        sftp.close()
+        # Send the configuration already rendered on the control node instead
+        if self.rendered is not None:
+            self.log.info("| Sending the rendered configuration templates")
+            self.pushDirectory(self.rendered, self.deployroot, label="templates")
+            return
+
+        # Copy over the bin/detoken.py script
+        detoken = self.helper("detoken.py")
 
         # Run the detokeniser
-        Boss.bosslog.info("| Detokenising the configuration templates")
+        self.log.info("| Detokenising the configuration templates")
         self.mkdirs(self.deployroot)
 
-        for line in self.execute("{0} -c {1} -t {2} -d {3}".format(os.path.join(self.configroot, "detoken.py"),
-                                  os.path.join(self.configroot, "conf", "{0}-{1}.properties".format(self.context, self.environment)),
-                                  os.path.join(self.configroot, "templates"),
-                                  self.deployroot
-                                 )):
-            Boss.bosslog.info("| | {0}".format(line))
+        timing = self.timer("detoken")
+        result = self.execute("{0} -j {4} -c {1} -t {2} -d {3}".format(detoken,
+                              os.path.join(self.configroot, "conf", "{0}-{1}.properties".format(self.context, self.environment)),
+                              os.path.join(self.configroot, "templates"),
+                              self.deployroot,
+                              self.detokenjobs
+                             ))
+        for line in result:
+            self.log.info("| | %s", line)
+
+        timing.status = result.status
+        timing.finish()
 
-    def execute(self, command):
+        if result.status != 0:
+            raise Exception("Detokenisation failed with exit code {0}".format(result.status))
+
+    def timer(self, phase, name=None):
         """
-        Class method to execute a command remotely.
+        Class method to start timing a phase of the deployment to this host.
 
-        Returns: A tuple (errorcode, output)
+        Returns: A timing, which records nothing unless the client has a report
+        """
+
+        return Boss.timing(self.report, self.hostname, phase, name)
+
+    def compressLevel(self, paths):
+        """
+        Class method to choose how hard to compress local files sent together.
+
+        Returns: A zlib level, 0 for none
+        """
+
+        if self.compression is None:
+            return 0
+
+        return self.compression.stream(paths)
+
+    def archiver(self, members, level=0):
+        """
+        Class method to build a function that writes local files to a stream as a tar archive, gzipped
+        at the level given.  Members are tuples (local path, name in the archive).
+
+        Returns: A function
         """
 
-        channel = self.client.get_transport().open_session()
+        def send(stream):
+            if level:
+                stream = Boss.compressingfile(stream, level)
+
+            archive = tarfile.open(fileobj=stream, mode="w|")
+            for (local_file, arcname) in members:
+                archive.add(local_file, arcname=arcname)
+            archive.close()
+
+            if level:
+                stream.close()
+                self.saved += stream.raw - stream.count
+
+        return send
+
+    def openSftp(self):
+        """
+        Class method to open a new SFTP session over the host's transport.
+        """
+
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+    def getSftp(self):
+        """
+        Class method to return the client's own SFTP session, opening it the first time.
+        """
+
+        if self.sftp is None:
+            self.sftp = self.openSftp()
+
+        return self.sftp
+
+    def helper(self, name):
+        """
+        Class method to copy one of the bin/ helper scripts to the remote host, once per client.
+
+        Returns: The remote path to the helper
+        """
+
+        if self.helpers is None:
+            self.helpers = {}
+
+        if name not in self.helpers:
+            remote_file = os.path.join(self.remote_basedir, name)
+
+            sftp = self.getSftp()
+            sftp.put(os.path.join(Boss.__install__, "bin", name), remote_file)
+            sftp.chmod(remote_file, 0755)
+
+            self.sent += os.stat(os.path.join(Boss.__install__, "bin", name)).st_size
+
+            self.helpers[name] = remote_file
+
+        return self.helpers[name]
+
+    def upload(self, local_file, remote_file):
+        """
+        Class method to copy a single file to the remote host.
+        """
+
+        with self.timer("push", os.path.basename(local_file)) as timing:
+            sent = self.sent
+
+            self.putFile(self.getSftp(), local_file, remote_file)
+
+            timing.bytes = self.sent - sent
+
+    def relay(self, command):
+        """
+        Class method to run a command on the remote host that passes something on to another host,
+        forwarding the SSH agent if there is one so the remote host can authenticate as we do.
+        """
+
+        with self.timer("relay", command) as timing:
+            channel = self.transport.open_session()
+            channel.set_combine_stderr(True)
+            if "SSH_AUTH_SOCK" in os.environ:
+                paramiko.agent.AgentRequestHandler(channel)
+
+            channel.exec_command(command)
+            channel.shutdown_write()
+
+            output = channel.makefile("rb").read()
+            timing.status = channel.recv_exit_status()
+            channel.close()
+
+        if timing.status != 0:
+            raise Exception("Relay failed with status {0}: {1}".format(timing.status, output.strip()))
+
+    def execute(self, command, stdin=None):
+        """
+        Class method to execute a command remotely, optionally feeding it input.
+
+        Returns: A session to iterate over for each line of output, holding the exit status once finished
+        """
+
+        channel = self.transport.open_session()
 
         # Combine the output for stdout and stderr
         channel.set_combine_stderr(True)
 
         # Run the command
         channel.exec_command(command)
+        if stdin is not None:
+            self.sendInput(channel, stdin)
+
+        return Boss.session(channel, self.timer("execute", command))
+
+    def sendInput(self, channel, stdin):
+        """
+        Class method to feed input to a remote command and signal the end of it.  The input is either
+        a string or a function that writes to a file-like object.
+        """
+
+        if callable(stdin):
+            stream = countingfile(channel.makefile("wb"))
+            stdin(stream)
+            stream.flush()
+            self.sent += stream.count
+        elif stdin is not None:
+            channel.sendall(stdin)
+            self.sent += len(stdin)
+
+        channel.shutdown_write()
+
+    def capture(self, command, stdin=None):
+        """
+        Class method to execute a command remotely, optionally feeding it input, and collect all of its output.
+
+        Returns: A tuple (errorcode, output)
+        """
+
+        timing = self.timer("execute", command)
+
+        channel = self.transport.open_session()
+        channel.exec_command(command)
 
-        # Build output
-        while not channel.exit_status_ready():
-            if channel.recv_ready():
-                for line in channel.recv(8192).strip().split("\n"):
-                    yield line
+        self.sendInput(channel, stdin)
 
-        # Wait for the command to finish
-        channel.recv_exit_status()
+        output = channel.makefile("rb").read()
+        status = channel.recv_exit_status()
 
         channel.close()
 
+        timing.bytes = len(output)
+        timing.status = status
+        timing.finish()
+
+        return (status, output)
+
     def __str__(self):
         width = 40
         string =  "+" + "-" * (width + 2) + "+\n"
@@ -246,10 +953,45 @@ class client():
 
         return string
 
+    def close(self):
+        """
+        Class method to tidy up the temporary directory on the remote host, close the SFTP session and
+        hand back the transport.  It's safe to call more than once and doesn't raise, so it can follow
+        any failure.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            if self.sftp is not None:
+                self.sftp.close()
+            if self.transport is not None and self.transport.is_active():
+                # A payload from a relay that was never unpacked
+                if self.payload is not None:
+                    self.capture("rm -rf {0}".format(os.path.dirname(self.payload[0])))
+                if self.remote_basedir is not None:
+                    self.rmdirs(self.remote_basedir)
+        except Exception, e:
+            self.log.debug("Could not tidy up {0} on {1}: {2}".format(self.remote_basedir, self.hostname, e))
+        finally:
+            self.sftp = None
+            if self.transport is not None:
+                self.connections.release(self.hostname, self.username)
+            if self.owned:
+                self.connections.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+        return False
+
     def __del__(self):
-        # Attempt to tidy-up the temporary directory on the remote host
+        # Only a last resort for clients that were never closed
         try:
-            self.rmdirs(self.remote_basedir)
-            self.client.close()
-        except AttributeError:
+            self.close()
+        except Exception:
             pass
@@ -0,0 +1,129 @@
+import os
+import zlib
+
+# zlib levels for each setting
+LEVELS = {"none": 0, "fast": 1, "high": 9}
+
+# Files whose content is already compressed, judged by name alone
+COMPRESSED = (".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".lz", ".lzma", ".zst", ".z", ".zip", ".jar",
+              ".war", ".ear", ".whl", ".egg", ".7z", ".rar", ".rpm", ".deb", ".apk", ".png", ".jpg", ".jpeg",
+              ".gif", ".webp", ".mp3", ".mp4", ".m4a", ".mkv", ".mov", ".avi", ".ogg", ".webm", ".pdf", ".woff",
+              ".woff2")
+
+class compressingfile():
+    """
+    Class to gzip everything written through a file-like object, counting the bytes before and after.
+    """
+
+    def __init__(self, stream, level):
+        self.stream = stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.raw = 0
+        self.count = 0
+
+    def write(self, data):
+        self.raw += len(data)
+        self.send(self.compressor.compress(data))
+
+    def send(self, data):
+        if data:
+            self.count += len(data)
+            self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        """
+        Class method to write out the end of the compressed stream, leaving the stream itself open.
+        """
+
+        self.send(self.compressor.flush())
+        self.stream.flush()
+
+class compression():
+    """
+    Class for the policy deciding how hard to compress what's sent to the hosts: "none", "fast" or
+    "high" for everything, or "auto" to decide for each file.  Under "auto", files already compressed
+    by their name, or by a compressibility probe of their start, aren't compressed again; files that
+    shrink well get the high level and the rest the fast one.
+    """
+
+    # Bytes read from the start of a file to judge it
+    probesize = 65536
+
+    # Compressed-to-raw ratios from the fast level, above which a file isn't worth compressing and
+    # below which it's worth compressing hard
+    worthwhile = 0.9
+    shrinks = 0.5
+
+    def __init__(self, policy="none"):
+        if policy not in LEVELS and policy != "auto":
+            raise Exception("""No such compression policy as "{0}".""".format(policy))
+
+        self.policy = policy
+        self.levels = {}
+
+    def level(self, path):
+        """
+        Class method to choose the level for a single local file.
+
+        Returns: A zlib level, 0 for none
+        """
+
+        if self.policy != "auto":
+            return LEVELS[self.policy]
+
+        if os.path.splitext(path)[1].lower() in COMPRESSED:
+            return LEVELS["none"]
+
+        # Files are only probed again once they've changed
+        fstat = os.stat(path)
+        key = (path, fstat.st_size, fstat.st_mtime)
+        if key not in self.levels:
+            self.levels[key] = self.probe(path)
+
+        return self.levels[key]
+
+    def probe(self, path):
+        """
+        Class method to judge a file by how well its start compresses at the fast level.
+
+        Returns: A zlib level, 0 for none
+        """
+
+        with open(path, "rb") as infile:
+            sample = infile.read(self.probesize)
+
+        # Too small to gain anything from
+        if len(sample) < 512:
+            return LEVELS["none"]
+
+        ratio = float(len(zlib.compress(sample, LEVELS["fast"]))) / len(sample)
+        if ratio > self.worthwhile:
+            return LEVELS["none"]
+        elif ratio < self.shrinks:
+            return LEVELS["high"]
+
+        return LEVELS["fast"]
+
+    def stream(self, paths):
+        """
+        Class method to choose a single level for an archive of several local files, the one chosen for
+        the most bytes.
+
+        Returns: A zlib level, 0 for none
+        """
+
+        if self.policy != "auto":
+            return LEVELS[self.policy]
+
+        weights = {}
+        for path in paths:
+            level = self.level(path)
+            weights[level] = weights.get(level, 0) + os.stat(path).st_size
+
+        if not weights:
+            return LEVELS["none"]
+
+        return max(weights.iteritems(), key=lambda item: (item[1], -item[0]))[0]
@@ -0,0 +1,255 @@
+import os
+import time
+import socket
+import threading
+import paramiko
+import Boss
+
+def splithost(hostname):
+    """
+    Function to split a hostname of the form host[:port] into its address and port.
+
+    Returns: A tuple (address, port)
+    """
+
+    if hostname.count(":") == 1:
+        (address, port) = hostname.split(":")
+        return (address, int(port))
+
+    return (hostname, 22)
+
+class connections():
+    """
+    Class to keep authenticated SSH transports open and share them between clients, loading the host
+    keys and identities only once.  Each get() is matched by a release() once the transport is no
+    longer in use.  With a limit on open transports, the one idle longest is closed to make room for
+    another, or else the caller waits for one to become idle.
+    """
+
+    # The most transports to have open at once, or None for no limit
+    maxopen = None
+
+    # Seconds between keepalive packets on idle transports
+    keepalive = 30
+
+    # Seconds to wait for a host to accept the connection and then to send its SSH banner
+    connecttimeout = 10
+    bannertimeout = 15
+
+    # The identities tried, in addition to the SSH agent, as in ssh(1)
+    keyfiles = ["~/.ssh/id_rsa", "~/.ssh/id_dsa", "~/.ssh/id_ecdsa", "~/.ssh/id_ed25519"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transports = {}
+        self.hostlocks = {}
+        self.users = {}
+        self.idle = {}
+        self.opening = 0
+        self.available = threading.Condition(self.lock)
+        self.agent = None
+        self.identities = None
+        self.extrakeys = {}
+
+        # Known host keys, as SSHClient.load_system_host_keys()
+        self.hostkeys = paramiko.HostKeys()
+        try:
+            self.hostkeys.load(os.path.expanduser("~/.ssh/known_hosts"))
+        except IOError:
+            pass
+
+    def loadKeyfile(self, keyfile):
+        """
+        Class method to load a private key file of any supported type.  Keys that need a passphrase
+        are skipped.
+
+        Returns: A list holding the key, if it could be loaded
+        """
+
+        keyfile = os.path.expanduser(keyfile)
+        if not os.path.exists(keyfile):
+            return []
+
+        for keytype in (paramiko.RSAKey, paramiko.DSSKey, paramiko.ECDSAKey, getattr(paramiko, "Ed25519Key", None)):
+            if keytype is None:
+                continue
+            try:
+                return [keytype.from_private_key_file(keyfile)]
+            except paramiko.PasswordRequiredException:
+                Boss.bosslog.debug("Skipping {0}: it needs a passphrase".format(keyfile))
+                return []
+            except (paramiko.SSHException, IOError):
+                continue
+
+        return []
+
+    def loadIdentities(self):
+        """
+        Class method to load the private keys to authenticate with by default: those held by the SSH
+        agent and the usual files under ~/.ssh/.
+
+        Returns: A list of keys
+        """
+
+        identities = []
+
+        try:
+            self.agent = paramiko.Agent()
+            identities.extend(self.agent.get_keys())
+        except paramiko.SSHException:
+            pass
+
+        for keyfile in self.keyfiles:
+            identities.extend(self.loadKeyfile(keyfile))
+
+        return identities
+
+    def get(self, hostname, username, keyfile=None, timeouts=None):
+        """
+        Class method to return an authenticated transport to a host, reusing an open one if there is
+        one.  A key file is tried before the default identities.  The timeouts, a tuple (connect,
+        banner), apply to this call alone in place of the manager's own.
+
+        Returns: A paramiko.Transport
+        """
+
+        key = (username, hostname)
+
+        # Only one thread connects to any one host at a time
+        with self.lock:
+            hostlock = self.hostlocks.setdefault(key, threading.Lock())
+            if self.identities is None:
+                self.identities = self.loadIdentities()
+            identities = self.identities
+            if keyfile is not None:
+                if keyfile not in self.extrakeys:
+                    self.extrakeys[keyfile] = self.loadKeyfile(keyfile)
+                identities = self.extrakeys[keyfile] + identities
+
+        with hostlock:
+            with self.lock:
+                transport = self.transports.get(key)
+                if transport is not None and transport.is_active():
+                    self.users[key] = self.users.get(key, 0) + 1
+                    return transport
+
+                # Forget a transport that has dropped
+                if transport is not None:
+                    del self.transports[key]
+
+            if transport is not None:
+                transport.close()
+
+            self.reserve()
+            try:
+                transport = self.connect(hostname, username, identities, timeouts)
+            except Exception:
+                with self.available:
+                    self.opening -= 1
+                    self.available.notify_all()
+                raise
+
+            # The reservation becomes the transport in one step, so the limit holds throughout
+            with self.lock:
+                self.opening -= 1
+                self.transports[key] = transport
+                self.users[key] = self.users.get(key, 0) + 1
+
+            return transport
+
+    def reserve(self):
+        """
+        Class method to wait for room to open another transport, closing the one idle longest if the
+        limit has been reached.
+        """
+
+        closing = []
+        with self.available:
+            while self.maxopen is not None and len(self.transports) + self.opening >= self.maxopen:
+                idle = [key for key in self.transports if not self.users.get(key)]
+                if not idle:
+                    self.available.wait()
+                    continue
+
+                oldest = min(idle, key=lambda key: self.idle.get(key, 0))
+                self.idle.pop(oldest, None)
+                closing.append(self.transports.pop(oldest))
+
+            self.opening += 1
+
+        # Closing waits for the transport's thread, so is done outside the lock
+        for transport in closing:
+            transport.close()
+
+    def release(self, hostname, username):
+        """
+        Class method to hand back a transport from get() once it's no longer in use, leaving it open
+        for reuse.
+        """
+
+        key = (username, hostname)
+
+        with self.available:
+            if self.users.get(key):
+                self.users[key] -= 1
+            if not self.users.get(key):
+                self.users.pop(key, None)
+                self.idle[key] = time.time()
+                self.available.notify_all()
+
+    def connect(self, hostname, username, identities, timeouts=None):
+        """
+        Class method to open, verify and authenticate a new transport to a host.
+
+        Returns: A paramiko.Transport
+        """
+
+        (address, port) = splithost(hostname)
+        (connecttimeout, bannertimeout) = timeouts or (self.connecttimeout, self.bannertimeout)
+
+        sock = socket.create_connection((address, port), connecttimeout)
+        transport = paramiko.Transport(sock)
+        transport.banner_timeout = bannertimeout
+        try:
+            transport.start_client()
+
+            # Refuse a host whose key has changed, but allow unknown hosts
+            serverkey = transport.get_remote_server_key()
+            lookup = address if port == 22 else "[{0}]:{1}".format(address, port)
+            known = self.hostkeys.lookup(lookup)
+            if known is not None and serverkey.get_name() in known and known[serverkey.get_name()] != serverkey:
+                raise paramiko.BadHostKeyException(address, serverkey, known[serverkey.get_name()])
+
+            for identity in identities:
+                try:
+                    transport.auth_publickey(username, identity)
+                except paramiko.AuthenticationException:
+                    continue
+                if transport.is_authenticated():
+                    break
+            else:
+                raise paramiko.AuthenticationException("No identity was accepted for {0}@{1}".format(username, hostname))
+
+            transport.set_keepalive(self.keepalive)
+        except Exception:
+            transport.close()
+            raise
+
+        return transport
+
+    def close(self):
+        """
+        Class method to close every open transport.
+        """
+
+        with self.lock:
+            transports = self.transports.values()
+            self.transports = {}
+            self.users = {}
+            self.idle = {}
+
+        for transport in transports:
+            transport.close()
+
+        if self.agent is not None:
+            self.agent.close()
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import Queue
+import logging
+import itertools
+import threading
+import traceback
+import collections
+import SocketServer
+import ConfigParser
+import BaseHTTPServer
+import Boss
+
+class job():
+    """
+    Class for a single deployment, or rollback, queued with the daemon.  The most recent lines of
+    the job's log output are kept so it can be followed while the job runs.
+    """
+
+    # Lines of log output to keep; anyone following further behind is told how many they missed
+    keeplines = 10000
+
+    def __init__(self, id, project, environment, context, parallel=1, rollback=False):
+        self.id = id
+        self.project = project
+        self.environment = environment
+        self.context = context
+        self.parallel = parallel
+        self.rollback = rollback
+
+        self.state = "queued"
+        self.error = None
+        self.summary = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+        self.lines = collections.deque(maxlen=self.keeplines)
+        self.total = 0
+        self.changed = threading.Condition()
+
+    def thread(self):
+        """
+        Class method to return the name given to the thread running the job.  Threads started by the
+        job are named after it.
+        """
+
+        return "job-{0}".format(self.id)
+
+    def add(self, line):
+        """
+        Class method to add a line of log output and wake anyone following the job.
+        """
+
+        with self.changed:
+            self.lines.append(line)
+            self.total += 1
+            self.changed.notify_all()
+
+    def finish(self, state, error=None):
+        """
+        Class method to record the outcome of the job.
+        """
+
+        with self.changed:
+            self.state = state
+            self.error = error
+            self.finished = time.time()
+            self.changed.notify_all()
+
+    def follow(self):
+        """
+        Class method to yield each line of log output, waiting for more until the job has finished.
+        Lines no longer kept are skipped over with a note of how many.
+        """
+
+        position = 0
+        while True:
+            with self.changed:
+                while position == self.total and self.finished is None:
+                    self.changed.wait(1)
+
+                first = self.total - len(self.lines)
+                missed = max(0, first - position)
+                position = max(position, first)
+
+                lines = list(itertools.islice(self.lines, position - first, None))
+                finished = self.finished is not None
+            position += len(lines)
+
+            if missed:
+                yield "[{0} lines no longer kept]".format(missed)
+            for line in lines:
+                yield line
+
+            if finished and position == self.total:
+                return
+
+    def describe(self):
+        """
+        Class method to describe the job.
+
+        Returns: A dictionary
+        """
+
+        description = {
+            "id": self.id,
+            "project": self.project,
+            "environment": self.environment,
+            "context": self.context,
+            "parallel": self.parallel,
+            "rollback": self.rollback,
+            "state": self.state,
+            "queued": self.queued,
+            "started": self.started,
+            "finished": self.finished,
+            "lines": self.total,
+        }
+        if self.error is not None:
+            description["error"] = self.error
+        if self.summary is not None:
+            description["summary"] = self.summary
+
+        return description
+
+class joblog(logging.Handler):
+    """
+    Class to pass log records on to the jobs whose threads logged them.
+    """
+
+    def __init__(self, daemon):
+        logging.Handler.__init__(self)
+        self.daemon = daemon
+        self.setFormatter(logging.Formatter("%(message)s"))
+
+    def emit(self, record):
+        """
+        Class method to add a record to the job it belongs to, if any.
+        """
+
+        current = self.daemon.running.get(record.threadName.split("/")[0])
+        if current is not None:
+            current.add(self.format(record))
+
+class daemon():
+    """
+    Class for a long-running deployment service.  Jobs are queued per environment and context,
+    whatever the project, and each queue's jobs run one at a time in order, so no two jobs deploy to
+    the same hosts at once while different contexts deploy side by side.  The SSH transports are
+    kept open between jobs, up to the "max connections" set in boss.conf.
+    """
+
+    # Finished jobs to remember
+    history = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.queues = {}
+        self.running = {}
+
+        # The transports are shared by every job, so are limited by the main configuration alone
+        bossconf = ConfigParser.ConfigParser()
+        bossconf.read(os.path.join(Boss.__install__, "conf", "boss.conf"))
+        try:
+            maxopen = bossconf.getint("BOSS", "max connections")
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            maxopen = 256
+
+        self.connections = Boss.connections()
+        self.connections.maxopen = maxopen if maxopen > 0 else None
+
+        self.handler = joblog(self)
+        logging.getLogger().addHandler(self.handler)
+
+    def submit(self, project, environment, context, parallel=1, rollback=False):
+        """
+        Class method to queue a job, starting a worker for its environment and context if there isn't
+        one.
+
+        Returns: A job
+        """
+
+        with self.lock:
+            current = job(self.ids.next(), project, environment, context, parallel, rollback)
+            self.jobs[current.id] = current
+
+            # Forget the oldest finished jobs
+            finished = sorted(id for (id, old) in self.jobs.iteritems() if old.finished is not None)
+            for id in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[id]
+
+            key = (environment, context)
+            if key not in self.queues:
+                self.queues[key] = Queue.Queue()
+                worker = threading.Thread(target=self.work, args=(self.queues[key],), name="context-{0}-{1}".format(*key))
+                worker.daemon = True
+                worker.start()
+
+            self.queues[key].put(current)
+
+        return current
+
+    def work(self, jobs):
+        """
+        Class method to run the jobs queued for a single environment and context, one after another.
+        """
+
+        while True:
+            current = jobs.get()
+
+            # Log records are matched to the job by the name of the thread
+            threading.current_thread().name = current.thread()
+            self.running[current.thread()] = current
+            try:
+                self.run(current)
+            finally:
+                del self.running[current.thread()]
+
+    def run(self, current):
+        """
+        Class method to run a single job.
+        """
+
+        current.state = "running"
+        current.started = time.time()
+
+        report = Boss.report()
+        try:
+            system = Boss.server(current.project, current.environment, current.context)
+            system.report = report
+            system.connections = self.connections
+            if current.rollback:
+                system.rollback(current.parallel)
+            else:
+                system.deploy(current.parallel)
+        except Exception, e:
+            Boss.bosslog.error("There was an error: {0}".format(e))
+            Boss.bosslog.debug(traceback.format_exc())
+            current.summary = report.summary()
+            current.finish("failed", str(e))
+        else:
+            current.summary = report.summary()
+            current.finish("succeeded")
+
+    def close(self):
+        """
+        Class method to close the open transports.
+        """
+
+        logging.getLogger().removeHandler(self.handler)
+        self.connections.close()
+
+class requesthandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Class to answer the daemon's HTTP API:
+
+        POST /jobs             queue a job from a JSON object with "project", "environment" and
+                               "context", and optionally "parallel" and "rollback"
+        GET  /jobs             describe every job
+        GET  /jobs/<id>        describe a job, with its report once it has finished
+        GET  /jobs/<id>/log    stream a job's log output until it has finished
+    """
+
+    def reply(self, code, body):
+        """
+        Class method to send a JSON response.
+        """
+
+        data = json.dumps(body, indent=2, sort_keys=True) + "\n"
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def find(self, id):
+        """
+        Class method to look up a job by its ID.
+
+        Returns: A job, or None
+        """
+
+        try:
+            return self.server.daemon.jobs.get(int(id))
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/").split("/")
+
+        if path == ["jobs"]:
+            jobs = sorted(self.server.daemon.jobs.values(), key=lambda current: current.id)
+            return self.reply(200, [current.describe() for current in jobs])
+
+        if len(path) in (2, 3) and path[0] == "jobs":
+            current = self.find(path[1])
+            if current is None:
+                return self.reply(404, {"error": "No such job"})
+
+            if len(path) == 2:
+                return self.reply(200, current.describe())
+
+            if path[2] == "log":
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.end_headers()
+                for line in current.follow():
+                    self.wfile.write(line + "\n")
+                    self.wfile.flush()
+                self.wfile.write("{0}\n".format(current.state.upper()))
+                return
+
+        self.reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path.split("?")[0].strip("/") != "jobs":
+            return self.reply(404, {"error": "Not found"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", "0"))))
+            missing = [field for field in ("project", "environment", "context") if not request.get(field)]
+            if missing:
+                raise ValueError("Missing {0}".format(", ".join(missing)))
+            parallel = int(request.get("parallel", 1))
+        except (ValueError, TypeError, AttributeError), e:
+            return self.reply(400, {"error": str(e)})
+
+        current = self.server.daemon.submit(request["project"], request["environment"], request["context"], parallel, bool(request.get("rollback")))
+        self.reply(202, current.describe())
+
+    def log_message(self, format, *args):
+        Boss.bosslog.debug("{0} {1}".format(self.address_string(), format % args))
+
+class httpserver(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Class for the daemon's HTTP server, answering each request on a thread of its own.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, daemon):
+        BaseHTTPServer.HTTPServer.__init__(self, address, requesthandler)
+        self.daemon = daemon
@@ -0,0 +1,168 @@
+import os
+import time
+import cPickle
+import tempfile
+import threading
+import Boss
+
+class hashindex():
+    """
+    Class for a persistent index of the checksums of local files, so a file is only read again once
+    it has changed.  A file is taken to be unchanged while its size, modification time and inode
+    are.  Trees are walked once for the life of the index, however many hosts ask for them.
+    """
+
+    # Files modified this recently may change again within the same mtime, so aren't remembered
+    settle = 2
+
+    def __init__(self, indexfile, workers=1):
+        self.indexfile = indexfile
+        self.workers = workers
+
+        self.entries = {}
+        self.trees = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        self.treelocks = {}
+
+        try:
+            with open(self.indexfile, "rb") as infile:
+                self.entries = cPickle.load(infile)
+        except Exception, e:
+            # A missing or unreadable index only costs the checksums again
+            if os.path.exists(self.indexfile):
+                Boss.bosslog.debug("Could not load the hash index {0}: {1}".format(self.indexfile, e))
+
+    def checksums(self, paths):
+        """
+        Class method to checksum local files, reading only those not in the index or changed since,
+        on a pool of worker threads.
+
+        Returns: A dictionary of the paths mapped to their checksums
+        """
+
+        results = {}
+        missing = {}
+        for path in paths:
+            fstat = os.stat(path)
+            key = (fstat.st_size, fstat.st_mtime, fstat.st_ino)
+
+            entry = self.entries.get(path)
+            if entry is not None and entry[:3] == key:
+                results[path] = entry[3]
+            else:
+                missing[path] = key
+
+        if not missing:
+            return results
+
+        def checksum(path):
+            results[path] = Boss.filehash(path)
+
+        failures = Boss.concurrently(checksum, missing.keys(), self.workers)
+        for path, error in failures.iteritems():
+            if error is not None:
+                raise Exception("Could not checksum {0}: {1}".format(path, error))
+
+        settled = time.time() - self.settle
+        with self.lock:
+            for path, key in missing.iteritems():
+                if key[1] < settled:
+                    self.entries[path] = key + (results[path],)
+                    self.changed = True
+
+        return results
+
+    def checksum(self, path):
+        """
+        Class method to checksum a single local file.
+
+        Returns: A string
+        """
+
+        return self.checksums([path])[path]
+
+    def tree(self, src_dir):
+        """
+        Class method to describe every file in a local directory.  Each directory is only walked once,
+        with anyone else asking for it in the meantime waiting for the result.
+
+        Returns: A tuple (directories, files) of relative paths, files mapped to tuples (checksum,
+                 size, mode)
+        """
+
+        src_dir = os.path.realpath(src_dir)
+
+        with self.lock:
+            treelock = self.treelocks.setdefault(src_dir, threading.Lock())
+
+        with treelock:
+            if src_dir in self.trees:
+                return self.trees[src_dir]
+
+            directories = []
+            stats = {}
+            for dirname, dirs, files in os.walk(src_dir):
+                directories.append(os.path.relpath(dirname, src_dir))
+                for file in files:
+                    local_file = os.path.join(dirname, file)
+                    stats[local_file] = os.stat(local_file)
+
+            checksums = self.checksums(stats.keys())
+
+            described = {}
+            for local_file, fstat in stats.iteritems():
+                described[os.path.relpath(local_file, src_dir)] = (checksums[local_file], fstat.st_size, fstat.st_mode & 07777)
+
+            # Forget the files that have gone from the tree
+            prefix = src_dir + os.sep
+            with self.lock:
+                for path in [path for path in self.entries if path.startswith(prefix) and path not in stats]:
+                    del self.entries[path]
+                    self.changed = True
+
+            self.save()
+
+            self.trees[src_dir] = (directories, described)
+            return self.trees[src_dir]
+
+    def manifest(self, src_dir):
+        """
+        Class method to build a manifest of a local directory.
+
+        Returns: A tuple (directories, files) of relative paths, files mapped to their checksums
+        """
+
+        (directories, described) = self.tree(src_dir)
+        return (directories, dict((path, entry[0]) for path, entry in described.iteritems()))
+
+    def save(self):
+        """
+        Class method to write the index out, if it has changed.
+        """
+
+        with self.lock:
+            if not self.changed:
+                return
+
+            tmpfile = None
+            try:
+                indexdir = os.path.dirname(self.indexfile)
+                if not os.path.isdir(indexdir):
+                    os.makedirs(indexdir)
+                # Write alongside, under a name of our own, and move into place, so neither a reader
+                # nor another run saving at the same time ever sees half an index
+                (fd, tmpfile) = tempfile.mkstemp(prefix=".index-", dir=indexdir)
+                with os.fdopen(fd, "wb") as outfile:
+                    cPickle.dump(self.entries, outfile, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmpfile, self.indexfile)
+                tmpfile = None
+                self.changed = False
+            except (IOError, OSError), e:
+                Boss.bosslog.debug("Could not save the hash index {0}: {1}".format(self.indexfile, e))
+            finally:
+                if tmpfile is not None:
+                    try:
+                        os.unlink(tmpfile)
+                    except OSError:
+                        pass
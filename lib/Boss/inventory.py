@@ -0,0 +1,233 @@
+import os
+import re
+import hashlib
+import cPickle
+import tempfile
+import itertools
+import Boss
+
+# A bracketed range or list within a host pattern, e.g. web[001-400] or db[1,3,5-7]
+RANGE_RE = re.compile(r"\[([^\[\]]+)\]")
+
+# A comma separating the entries of a host list, rather than one within a bracketed list
+SEPARATOR_RE = re.compile(r",(?![^\[\]]*\])")
+
+def expand(pattern):
+    """
+    Function to expand the bracketed ranges in a host pattern.  Numeric ranges keep the width of
+    their first number, so web[08-10] gives web08, web09 and web10; letters work too, as in
+    rack[a-c].  Several ranges give every combination.
+
+    Returns: A list of host names
+    """
+
+    parts = RANGE_RE.split(pattern)
+    if len(parts) == 1:
+        return [pattern]
+
+    choices = []
+    for (index, part) in enumerate(parts):
+        if index % 2 == 0:
+            choices.append([part])
+            continue
+
+        values = []
+        for item in part.split(","):
+            if "-" not in item:
+                values.append(item)
+                continue
+
+            (start, end) = item.split("-", 1)
+            if start.isdigit() and end.isdigit():
+                width = len(start) if start.startswith("0") else 0
+                values.extend(str(number).zfill(width) for number in range(int(start), int(end) + 1))
+            elif len(start) == 1 and len(end) == 1:
+                values.extend(chr(code) for code in range(ord(start), ord(end) + 1))
+            else:
+                raise ValueError("Bad range [{0}] in host pattern {1}".format(part, pattern))
+        choices.append(values)
+
+    return ["".join(combination) for combination in itertools.product(*choices)]
+
+class inventory():
+    """
+    Class for the hosts that can be deployed to, with the groups they belong to and any attributes.
+    Inventory files hold a host pattern per line followed by its groups and key=value attributes:
+
+        # pattern          groups   attributes
+        web[001-400].dc1   web dc1  role=frontend
+        db[1-3].dc1        db dc1   role=database
+
+    Parsed files are cached under cache/inventory/, keyed by their modification time and size.
+    """
+
+    def __init__(self, paths=None):
+        self.hosts = {}
+        self.order = []
+        self.groups = {}
+
+        for path in paths or []:
+            self.load(path)
+
+    def load(self, path):
+        """
+        Class method to add the hosts from an inventory file, from the cache if it's unchanged.
+        """
+
+        fstat = os.stat(path)
+        key = (os.path.realpath(path), fstat.st_mtime, fstat.st_size)
+
+        cachedir = os.path.join(Boss.__install__, "cache", "inventory")
+        cachefile = os.path.join(cachedir, hashlib.sha1(key[0]).hexdigest())
+
+        loaded = None
+        try:
+            with open(cachefile, "rb") as infile:
+                (cachedkey, cached) = cPickle.load(infile)
+            if cachedkey == key:
+                loaded = cached
+        except Exception, e:
+            # A missing or unreadable cache file only costs parsing the inventory again
+            if os.path.exists(cachefile):
+                Boss.bosslog.debug("Could not load the cached inventory {0}: {1}".format(cachefile, e))
+
+        if loaded is None:
+            part = inventory()
+            for (hostname, groups, attributes) in self.parse(path):
+                part.add(hostname, groups, attributes)
+            loaded = (part.hosts, part.order, part.groups)
+
+            tmpfile = None
+            try:
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir)
+                # Write alongside, under a name of our own, and move into place, so neither a reader
+                # nor another run caching the same file ever sees half a cache file
+                (fd, tmpfile) = tempfile.mkstemp(prefix=".inventory-", dir=cachedir)
+                with os.fdopen(fd, "wb") as outfile:
+                    cPickle.dump((key, loaded), outfile, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmpfile, cachefile)
+                tmpfile = None
+            except (IOError, OSError), e:
+                Boss.bosslog.debug("Could not cache the inventory {0}: {1}".format(path, e))
+            finally:
+                if tmpfile is not None:
+                    try:
+                        os.unlink(tmpfile)
+                    except OSError:
+                        pass
+
+        # The first file can be taken as it is
+        if not self.hosts:
+            (self.hosts, self.order, self.groups) = loaded
+            return
+
+        (hosts, order, groups) = loaded
+        for hostname in order:
+            self.add(hostname, *hosts[hostname])
+
+    def parse(self, path):
+        """
+        Class method to read an inventory file.
+
+        Returns: A list of tuples (hostname, groups, attributes)
+        """
+
+        entries = []
+        with open(path) as infile:
+            for (number, line) in enumerate(infile):
+                fields = line.split("#", 1)[0].split()
+                if not fields:
+                    continue
+
+                groups = [field for field in fields[1:] if "=" not in field]
+                attributes = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+
+                try:
+                    hostnames = expand(fields[0])
+                except ValueError, e:
+                    raise Exception("{0}, line {1}: {2}".format(path, number + 1, e))
+
+                entries.extend((hostname, groups, attributes) for hostname in hostnames)
+
+        return entries
+
+    def add(self, hostname, groups=(), attributes=None):
+        """
+        Class method to add a host, or more groups and attributes to a host already known.
+        """
+
+        if hostname not in self.hosts:
+            self.hosts[hostname] = ([], {})
+            self.order.append(hostname)
+
+        (hostgroups, hostattributes) = self.hosts[hostname]
+        for group in groups:
+            if group not in hostgroups:
+                hostgroups.append(group)
+                self.groups.setdefault(group, []).append(hostname)
+        hostattributes.update(attributes or {})
+
+    def match(self, entry):
+        """
+        Class method to find the hosts for a single entry in a host list: "@group" for the members of
+        a group, "@key=value" for the hosts with that attribute, or a host pattern.
+
+        Returns: A list of host names
+        """
+
+        if not entry.startswith("@"):
+            return expand(entry)
+
+        if "=" in entry:
+            (key, value) = entry[1:].split("=", 1)
+            return [hostname for hostname in self.order if self.hosts[hostname][1].get(key) == value]
+
+        if entry[1:] not in self.groups:
+            raise Exception("No such host group: {0}".format(entry[1:]))
+
+        return list(self.groups[entry[1:]])
+
+    def select(self, hostlist):
+        """
+        Class method to turn a comma separated host list into host names, in order and without
+        duplicates.  Entries starting "!" remove hosts, e.g. "@web, !@rack=r1, db[1,3-4]".
+
+        Returns: A list of host names
+        """
+
+        hosts = []
+        excluded = set()
+        for entry in SEPARATOR_RE.split(hostlist):
+            entry = entry.strip()
+            if not entry:
+                continue
+            if entry.startswith("!"):
+                excluded.update(self.match(entry[1:]))
+            else:
+                hosts.extend(self.match(entry))
+
+        seen = set()
+        selected = []
+        for hostname in hosts:
+            if hostname not in seen and hostname not in excluded:
+                seen.add(hostname)
+                selected.append(hostname)
+
+        return selected
+
+    def variables(self, hostname):
+        """
+        Class method to build the environment variables describing a host for its scripts:
+        HOST_GROUPS holds its groups and each attribute becomes HOST_<KEY>.
+
+        Returns: A dictionary
+        """
+
+        (groups, attributes) = self.hosts.get(hostname, ([], {}))
+
+        variables = {"HOST_GROUPS": " ".join(groups)}
+        for (key, value) in attributes.iteritems():
+            variables["HOST_" + re.sub(r"\W", "_", key).upper()] = value
+
+        return variables
@@ -0,0 +1,226 @@
+import os
+import time
+import json
+import logging
+import threading
+import collections
+
+class jsonformatter(logging.Formatter):
+    """
+    Class to format log records as single JSON objects, one per line.
+    """
+
+    def format(self, record):
+        """
+        Class method to format a record as JSON, taking the host from records logged through a hostlog.
+
+        Returns: A string
+        """
+
+        message = record.getMessage()
+
+        entry = {"time": round(record.created, 3), "level": record.levelname, "logger": record.name}
+
+        host = getattr(record, "host", None)
+        if host is not None:
+            # The host has a field of its own, so drop the prefix from each line
+            prefix = "[{0}] ".format(host)
+            message = "\n".join(line[len(prefix):] if line.startswith(prefix) else line for line in message.split("\n"))
+            entry["host"] = host
+
+        entry["message"] = message
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, sort_keys=True)
+
+class logsink(logging.Handler):
+    """
+    Class to take log records off the logging thread and pass them on from a background thread, in
+    batches, to other handlers and to a log file per host.
+    """
+
+    # The most records to hold before logging waits, and to write in one go
+    queuesize = 10000
+    batchsize = 1000
+
+    # Seconds to let records gather once woken, so they're written in batches
+    interval = 0.05
+
+    # Host log files kept open at once; the least recently written is closed beyond this
+    maxfiles = 64
+
+    def __init__(self, handlers=None, logdir=None):
+        logging.Handler.__init__(self)
+
+        self.handlers = list(handlers or [])
+        self.logdir = logdir
+        self.hostfiles = collections.OrderedDict()
+
+        if self.logdir is not None and not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+
+        # Appending to a deque needs no lock, which keeps queuing a record cheap
+        self.records = collections.deque()
+        self.pending = threading.Event()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        """
+        Class method to queue a record; all the formatting is left to the background thread.
+        """
+
+        # Let the background thread catch up if it's falling too far behind
+        while len(self.records) >= self.queuesize and self.thread.is_alive():
+            time.sleep(0.01)
+
+        self.queue(record)
+
+    def queue(self, item):
+        """
+        Class method to queue a record, or a marker, and wake up the background thread.
+        """
+
+        self.records.append(item)
+        if not self.pending.is_set():
+            self.pending.set()
+
+    def run(self):
+        """
+        Class method to write out queued records until a None is queued.  An Event queued among the
+        records is set once those before it have been written.
+        """
+
+        while True:
+            self.pending.wait()
+            time.sleep(self.interval)
+            self.pending.clear()
+
+            batch = []
+            while self.records:
+                item = self.records.popleft()
+                if isinstance(item, logging.LogRecord):
+                    batch.append(item)
+                    if len(batch) < self.batchsize:
+                        continue
+
+                self.write(batch)
+                batch = []
+
+                if item is None:
+                    return
+                elif isinstance(item, threading._Event):
+                    item.set()
+
+            self.write(batch)
+
+    def write(self, records):
+        """
+        Class method to write a batch of records, with a single write and flush for each stream.
+        """
+
+        streams = []
+        lines = {}
+        hostlines = collections.OrderedDict()
+
+        def add(stream, line):
+            if stream not in lines:
+                streams.append(stream)
+                lines[stream] = []
+            lines[stream].append(line)
+
+        if not records:
+            return
+
+        for record in records:
+            for handler in self.handlers:
+                if record.levelno < handler.level or not handler.filter(record):
+                    continue
+                try:
+                    # Stream handlers, and so file handlers, have their lines gathered up
+                    if isinstance(handler, logging.StreamHandler):
+                        add(handler, handler.format(record))
+                    else:
+                        handler.handle(record)
+                except Exception:
+                    self.handleError(record)
+
+            host = getattr(record, "host", None)
+            if self.logdir is not None and host is not None:
+                try:
+                    hostlines.setdefault(host, []).append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+
+        for stream in streams:
+            text = "\n".join(lines[stream]) + "\n"
+            try:
+                if isinstance(stream, logging.StreamHandler):
+                    stream.acquire()
+                    try:
+                        stream.stream.write(text)
+                        stream.flush()
+                    finally:
+                        stream.release()
+                else:
+                    stream.write(text)
+                    stream.flush()
+            except Exception:
+                pass
+
+        for host, hostlog in hostlines.iteritems():
+            try:
+                hostfile = self.hostfile(host)
+                hostfile.write("\n".join(hostlog) + "\n")
+                hostfile.flush()
+            except Exception:
+                pass
+
+    def hostfile(self, host):
+        """
+        Class method to open the log file for a host, reusing it while it's among the most recently
+        written, and closing the least recently written beyond the limit.
+
+        Returns: A file object
+        """
+
+        if host in self.hostfiles:
+            hostfile = self.hostfiles.pop(host)
+        else:
+            while len(self.hostfiles) >= self.maxfiles:
+                self.hostfiles.popitem(last=False)[1].close()
+            hostfile = open(os.path.join(self.logdir, "{0}.log".format(host.replace(os.sep, "_"))), "a")
+
+        # Most recently written last
+        self.hostfiles[host] = hostfile
+
+        return hostfile
+
+    def flush(self):
+        """
+        Class method to wait until every record queued so far has been written.
+        """
+
+        if self.thread.is_alive():
+            written = threading.Event()
+            self.queue(written)
+            written.wait()
+
+    def close(self):
+        """
+        Class method to write out anything still queued, stop the background thread and close the host
+        log files.
+        """
+
+        if self.thread.is_alive():
+            self.queue(None)
+            self.thread.join()
+
+        for hostfile in self.hostfiles.values():
+            hostfile.close()
+        self.hostfiles = collections.OrderedDict()
+
+        logging.Handler.close(self)
@@ -0,0 +1,150 @@
+import copy
+import json
+import time
+import heapq
+import threading
+
+class timing():
+    """
+    Class to time a single phase of a deployment, either as a context manager or by calling finish().
+    """
+
+    def __init__(self, report, host, phase, name=None):
+        self.report = report
+        self.host = host
+        self.phase = phase
+        self.name = name
+        self.bytes = None
+        self.saved = None
+        self.status = None
+        self.started = time.time()
+
+    def finish(self, error=None):
+        """
+        Class method to record the time taken so far, along with any bytes sent and saved by
+        compression, exit status and error.
+        """
+
+        if self.report is not None:
+            self.report.record(self.host, self.phase, self.name, time.time() - self.started, self.bytes, self.status, error, self.saved)
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.finish(None if value is None else str(value))
+        return False
+
+class report():
+    """
+    Class to collect the timings of every phase of a deployment across all hosts.  The totals are
+    kept up to date as each phase is recorded, so only a limited number of the records themselves,
+    and of the slowest scripts, need be held however many hosts are deployed to.
+    """
+
+    # The phases that make up a host's deployment, as opposed to those nested within them
+    toplevel = ("connect", "push", "detoken", "scripts")
+
+    # Records kept in full for the summary, and slowest scripts remembered
+    keep = 10000
+    slowest = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.dropped = 0
+        self.hosts = {}
+        self.phases = {}
+        self.scripts = []
+
+    def record(self, host, phase, name, seconds, bytes=None, status=None, error=None, saved=None):
+        """
+        Class method to record the outcome of a single phase, adding it to the totals.
+        """
+
+        entry = {"host": host, "phase": phase, "name": name, "seconds": round(seconds, 3)}
+        if bytes is not None:
+            entry["bytes"] = bytes
+        if saved is not None:
+            entry["saved"] = saved
+        if status is not None:
+            entry["status"] = status
+        if error is not None:
+            entry["error"] = error
+
+        with self.lock:
+            if len(self.records) < self.keep:
+                self.records.append(entry)
+            else:
+                self.dropped += 1
+
+            totals = self.hosts.setdefault(host, {"seconds": 0.0, "bytes": 0, "saved": 0, "phases": {}})
+            if phase == "host":
+                totals["seconds"] = entry["seconds"]
+                if error is not None:
+                    totals["error"] = error
+            elif phase in self.toplevel:
+                totals["phases"][phase] = round(totals["phases"].get(phase, 0.0) + entry["seconds"], 3)
+                totals["bytes"] += bytes or 0
+                totals["saved"] += saved or 0
+
+            totals = self.phases.setdefault(phase, {"count": 0, "seconds": 0.0, "max": 0.0, "bytes": 0, "saved": 0})
+            totals["count"] += 1
+            totals["seconds"] = round(totals["seconds"] + entry["seconds"], 3)
+            totals["max"] = max(totals["max"], entry["seconds"])
+            totals["bytes"] += bytes or 0
+            totals["saved"] += saved or 0
+
+            # A heap of the slowest scripts, the quickest of them first
+            if phase == "script":
+                item = (entry["seconds"], -(len(self.records) + self.dropped), entry)
+                if len(self.scripts) < self.slowest:
+                    heapq.heappush(self.scripts, item)
+                elif item > self.scripts[0]:
+                    heapq.heapreplace(self.scripts, item)
+
+    def timer(self, host, phase, name=None):
+        """
+        Class method to start timing a phase.
+
+        Returns: A timing
+        """
+
+        return timing(self, host, phase, name)
+
+    def summary(self, top=10):
+        """
+        Class method to summarise the timings by host and by phase, picking out the slowest hosts and scripts.
+
+        Returns: A dictionary
+        """
+
+        with self.lock:
+            hosts = copy.deepcopy(self.hosts)
+            phases = copy.deepcopy(self.phases)
+            scripts = [entry for (seconds, order, entry) in sorted(self.scripts, reverse=True)]
+            records = list(self.records)
+            dropped = self.dropped
+
+        slowest = heapq.nlargest(top, hosts.iteritems(), key=lambda item: item[1]["seconds"])
+
+        summary = {
+            "hosts": hosts,
+            "phases": phases,
+            "slowest hosts": [{"host": name, "seconds": host["seconds"]} for (name, host) in slowest],
+            "slowest scripts": scripts[:top],
+            "records": records,
+        }
+        if dropped:
+            summary["records dropped"] = dropped
+
+        return summary
+
+    def write(self, path):
+        """
+        Class method to write the summary out as JSON.
+        """
+
+        with open(path, "w") as outfile:
+            json.dump(self.summary(), outfile, indent=2, sort_keys=True)
@@ -2,9 +2,67 @@
 
 # Base libraries
 import os
+import sys
+import math
+import time
+import Queue
+import random
+import shutil
+import string
+import getpass
+import hashlib
+import tarfile
+import tempfile
+import threading
+import multiprocessing
+import subprocess
 import ConfigParser
 import Boss
 
+# The process's umask, read once here as it can only be read by changing it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def concurrently(function, items, workers):
+    """
+    Function to call a function for each item on a pool of worker threads.  An exception for one item
+    doesn't stop the others.
+
+    Returns: A dictionary of the items mapped to the exception raised for each, or None
+    """
+
+    # Queue up the items for the workers to pick from
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                function(item)
+            except Exception, e:
+                results[item] = e
+            else:
+                results[item] = None
+
+    # Named after the calling thread, so log records can be traced back to it
+    parent = threading.current_thread().name
+    threads = [threading.Thread(target=worker, name="{0}/{1}".format(parent, x)) for x in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
 class server():
     """
     Class for the main BOSS system.
@@ -12,6 +70,13 @@ class server():
 
     hosts = {}
     varmap = {}
+    rendered = None
+    report = None
+    connections = None
+    payload = None
+    payloadhosts = None
+    release = None
+    timeouts = None
 
     def __init__(self, project, environment, context):
         self.project = project
@@ -35,16 +100,31 @@ class server():
         self.common_scriptdir = os.path.join(Boss.__install__, "common", "scripts")
 
         # Resolve the username and deployment path
-        self.user = self.resolve_option("ssh user", default=os.getlogin())
+        self.user = self.resolve_option("ssh user", default=getpass.getuser())
+        self.keyfile = self.resolve_option("ssh key")
+        if self.keyfile is not None:
+            self.keyfile = os.path.expanduser(self.keyfile)
         self.path = self.resolve_option("deploy path")
 
+        # Load any inventory files, relative to the project
+        inventories = self.resolve_option("inventory")
+        if inventories is not None:
+            inventories = [os.path.join(Boss.__install__, "projects", self.project, os.path.expanduser(path.strip())) for path in inventories.split(",") if path.strip()]
+
         # Determine the list of hosts
         try:
-            # Split the string by commas, and run through str.strip()
-            self.hosts = [host.strip() for host in self.resolve_option(self.context).split(",")]
+            self.inventory = Boss.inventory(inventories)
+            self.hosts = self.inventory.select(self.resolve_option(self.context))
         except Exception, e:
             raise Exception("""Could not determine the list of hosts for context "{0}": {1}""".format(self.context, e))
 
+        # Checksums of the project's files, kept between runs
+        workers = int(self.resolve_option("hash jobs", default=str(multiprocessing.cpu_count())))
+        self.hashes = Boss.hashindex(os.path.join(Boss.__install__, "cache", "hashes", self.project), workers)
+
+        # How hard to compress what's sent to the hosts
+        self.compression = Boss.compression(self.resolve_option("compression", default="none").strip().lower())
+
         # Perform the environment variable mappings, if any
         try:
             for var, value in self.bossconf.items("VAR MAPPING"):
@@ -73,25 +153,437 @@ class server():
                     # Fallback to the default
                     return default
 
-    def deploy(self):
+    def resolve_flag(self, option, default=False):
+        """
+        Method to resolve a yes/no configuration option as a boolean.
+        """
+
+        value = self.resolve_option(option)
+        if value is None:
+            return default
+
+        return value.strip().lower() in ("1", "yes", "true", "on")
+
+    def render(self):
+        """
+        Method to detokenise the project's templates once, on the control node.  The rendered tree is
+        cached under a hash of the templates, the properties and the detokeniser, so unchanged inputs
+        are never rendered twice.
+
+        Returns: The path to the rendered tree
+        """
+
+        projectdir = os.path.join(Boss.__install__, "projects", self.project)
+        templates = os.path.join(projectdir, "templates")
+        properties = os.path.join(projectdir, "conf", "{0}-{1}.properties".format(self.context, self.environment))
+        detoken = os.path.join(Boss.__install__, "bin", "detoken.py")
+
+        if not os.path.exists(properties):
+            raise Exception("""The "{0}" properties file does not exist.""".format(properties))
+
+        # Hash everything that can change the output, including file modes
+        digest = hashlib.sha1()
+        digest.update("detoken.py {0}\n".format(self.hashes.checksum(detoken)))
+        digest.update("properties {0}\n".format(self.hashes.checksum(properties)))
+        if os.path.isdir(templates):
+            (directories, files) = self.hashes.tree(templates)
+            for path in sorted(files):
+                if ".svn" in path.split(os.sep):
+                    continue
+                (checksum, size, mode) = files[path]
+                digest.update("{0} {1:o} {2}\n".format(path, mode, checksum))
+
+        cachedir = os.path.join(Boss.__install__, "cache", "rendered")
+        rendered = os.path.join(cachedir, digest.hexdigest())
+
+        if os.path.isdir(rendered):
+            Boss.bosslog.info("Using the cached rendered configuration: {0}".format(rendered))
+            return rendered
+
+        Boss.bosslog.info("Rendering the configuration templates: {0}".format(rendered))
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        # Render alongside and move into place, so a half-rendered tree is never used
+        workdir = tempfile.mkdtemp(prefix=".render-", dir=cachedir)
+        status = subprocess.call([sys.executable, detoken, "-j", self.resolve_option("detoken jobs", default="1"), "-c", properties, "-t", templates, "-d", workdir])
+        if status != 0:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise Exception("Rendering the configuration templates failed with exit code {0}".format(status))
+
+        # mkdtemp() leaves the tree's root private to us; give it the mode any other directory would get
+        os.chmod(workdir, 0777 & ~UMASK)
+
+        try:
+            os.rename(workdir, rendered)
+        except OSError:
+            # Someone else got there first
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        return rendered
+
+    def connect(self, hostname):
+        """
+        Method to connect to a host with the run's settings.
+
+        Returns: A Boss.client
+        """
+
+        return Boss.client(hostname, self.user, self.keyfile, self.report, self.connections, self.timeouts)
+
+    def distribute(self, parallel=1):
+        """
+        Method to send the pkg/ payload, as a single archive, to a few relay hosts which then pass it on
+        to the rest of the hosts in a tree; every host holding the payload sends it on to another in
+        each round.  The relays are those named by "relay hosts" or else the first "relay count" hosts.
+        Hosts the payload doesn't reach are sent pkg/ directly when they're configured.
+
+        Returns: A tuple (remote path, checksum) of the payload, or None if there's no pkg/ directory
+        """
+
+        pkgdir = os.path.join(Boss.__install__, "projects", self.project, "pkg")
+        if not os.path.isdir(pkgdir):
+            return None
+
+        relays = self.resolve_option("relay hosts")
+        if relays is not None:
+            relays = [host.strip() for host in relays.split(",") if host.strip() in self.hosts]
+        else:
+            relays = self.hosts[:int(self.resolve_option("relay count", default="1"))]
+
+        command = self.resolve_option("relay command", default="ssh -o BatchMode=yes -p {port} {user}@{address} 'mkdir -m 700 {directory} && cat > {payload}' < {payload}")
+
+        workdir = tempfile.mkdtemp(prefix="boss-payload-")
+        try:
+            # Build the payload once
+            archivefile = os.path.join(workdir, "pkg.tar")
+            archive = tarfile.open(archivefile, "w")
+            # Only pkg/'s contents, so the deploy path itself keeps the mode it already has
+            for name in sorted(os.listdir(pkgdir)):
+                archive.add(os.path.join(pkgdir, name), arcname=name)
+            archive.close()
+
+            checksum = Boss.filehash(archivefile)
+
+            # A directory of the run's own on every host, made where nobody can have got there first
+            rndstring = "".join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for x in range(16))
+            directory = os.path.join(Boss.client.tmpdir, "BOSS-payload-{0}".format(rndstring))
+            payload = os.path.join(directory, "pkg.tar")
+
+            Boss.bosslog.info("Distributing pkg/ through {0}".format(", ".join(relays)))
+
+            # Every host sent the payload, even in part, until its client takes charge of it
+            self.payloadhosts = set(relays)
+
+            # Upload to the relays
+            def upload(hostname):
+                with self.connect(hostname) as relay:
+                    (status, output) = relay.capture("mkdir -m 700 {0} 2>&1".format(directory))
+                    if status != 0:
+                        raise Exception("Could not create {0}: {1}".format(directory, output.strip()))
+                    relay.upload(archivefile, payload)
+
+            results = concurrently(upload, relays, parallel)
+            holders = [hostname for hostname in relays if results[hostname] is None]
+            for hostname in relays:
+                if results[hostname] is not None:
+                    Boss.bosslog.warn("| {0}: {1}".format(hostname, results[hostname]))
+
+            # Then from host to host, doubling the number of holders each round
+            def forward(pair):
+                (source, target) = pair
+                (address, port) = Boss.splithost(target)
+                with self.connect(source) as relay:
+                    relay.relay(command.format(user=self.user, address=address, port=port, hostname=target, directory=directory, payload=payload))
+
+            pending = [hostname for hostname in self.hosts if hostname not in holders]
+            while pending and holders:
+                pairs = zip(holders, pending)
+                pending = pending[len(pairs):]
+                self.payloadhosts.update(target for (source, target) in pairs)
+
+                results = concurrently(forward, pairs, parallel)
+                for (source, target) in pairs:
+                    if results[(source, target)] is None:
+                        Boss.bosslog.info("| {0} -> {1}".format(source, target))
+                        holders.append(target)
+                    else:
+                        Boss.bosslog.warn("| {0} -> {1}: {2}".format(source, target, results[(source, target)]))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        return (payload, checksum)
+
+    def prepareConnections(self):
+        """
+        Method to work out the run's connection timeouts and, if no connection manager was given, to
+        create one limited to the run's number of open connections.  A manager that was given may be
+        shared with other runs, so is left as it is.
+
+        Returns: True if the manager was created here, and so is to be closed at the end of the run
+        """
+
+        self.timeouts = (float(self.resolve_option("connect timeout", default=str(Boss.connections.connecttimeout))),
+                         float(self.resolve_option("banner timeout", default=str(Boss.connections.bannertimeout))))
+
+        owned = self.connections is None
+        if owned:
+            self.connections = Boss.connections()
+            maxopen = int(self.resolve_option("max connections", default="256"))
+            self.connections.maxopen = maxopen if maxopen > 0 else None
+
+        return owned
+
+    def preflight(self):
         """
-        Method to perform the main deployment run.
+        Method to connect to every host at once, within the connect and banner timeouts, before
+        anything is deployed.  Unreachable hosts either abort the deployment or, with "unreachable
+        hosts = exclude", are left out of it.
         """
 
-        # Loop through the hostnames for this project, environment and context.
-        for hostname in self.hosts:
+        def connect_one(hostname):
+            with Boss.timing(self.report, hostname, "connect"):
+                self.connections.get(hostname, self.user, self.keyfile, self.timeouts)
+                self.connections.release(hostname, self.user)
+
+        results = concurrently(connect_one, self.hosts, int(self.resolve_option("preflight parallel", default="32")))
+
+        unreachable = [hostname for hostname in self.hosts if results[hostname] is not None]
+        if not unreachable:
+            return
+
+        for hostname in unreachable:
+            Boss.bosslog.error("[{0}] Unreachable: {1}".format(hostname, results[hostname]), extra={"host": hostname})
+
+        if self.resolve_option("unreachable hosts", default="abort") != "exclude":
+            raise Exception("Could not connect to {0} of {1} hosts, so nothing was deployed: {2}".format(len(unreachable), len(self.hosts), ", ".join(unreachable)))
+
+        Boss.bosslog.warn("Leaving out the unreachable hosts: {0}".format(", ".join(unreachable)))
+        self.hosts = [hostname for hostname in self.hosts if hostname not in unreachable]
+
+    def waves(self):
+        """
+        Method to split the hosts into the waves they're deployed in: any canary hosts, named by
+        "canary hosts" or else the first "canary count" hosts, and then the rest in waves of "wave
+        size" hosts, or that percentage of them.
+
+        Returns: A list of lists of hosts
+        """
+
+        canaries = self.resolve_option("canary hosts")
+        if canaries is not None:
+            canaries = [host.strip() for host in canaries.split(",") if host.strip() in self.hosts]
+        else:
+            canaries = self.hosts[:int(self.resolve_option("canary count", default="0"))]
+
+        rest = [hostname for hostname in self.hosts if hostname not in canaries]
+
+        size = self.resolve_option("wave size")
+        if size is None:
+            size = len(rest)
+        elif size.strip().endswith("%"):
+            size = int(math.ceil(len(rest) * float(size.strip()[:-1]) / 100))
+        else:
+            size = int(size)
+        size = max(1, size)
+
+        waves = [canaries] if canaries else []
+        waves.extend(rest[start:start + size] for start in range(0, len(rest), size))
+
+        return waves or [[]]
+
+    def deploy(self, parallel=1):
+        """
+        Method to perform the main deployment run.  With a parallel value greater than one, the hosts
+        are deployed to concurrently by that many workers and a failing host does not stop the others.
+        Every host is connected to first, so unreachable hosts are found before any is deployed to.
+        """
+
+        # Keep the connections made up front for the deployment itself
+        owned = self.prepareConnections()
+
+        try:
+            self.preflight()
+
+            # Render the configuration up front when it's the same for every host
+            if self.resolve_option("render", default="remote") == "local":
+                self.rendered = self.render()
+
+            # Every host gets a release directory of the same name
+            if self.resolve_flag("releases"):
+                now = time.time()
+                self.release = "{0}.{1:06d}".format(time.strftime("%Y%m%d%H%M%S", time.localtime(now)), int(now % 1 * 1000000))
+
+            # Spread the pkg/ payload through relay hosts rather than from here to every host
+            if self.resolve_option("distribution", default="direct") == "relay":
+                self.payload = self.distribute(parallel)
+
+            # With canaries or waves, any failure stops the rollout unless a budget allows for it
+            waves = self.waves()
+            hostbudget = self.resolve_option("failure budget", default="0" if len(waves) > 1 else None)
+            scriptbudget = self.resolve_option("script failure budget", default="0" if len(waves) > 1 else None)
+
+            # Deploy host by host, stopping at the first failure
+            if parallel <= 1 and len(waves) == 1 and hostbudget is None and scriptbudget is None:
+                for hostname in self.hosts:
+                    self.deploy_host(hostname)
+                return
+
+            results = {}
+            scripts = {}
+            broken = []
+            skipped = []
+            halted = []
+
+            def deploy_one(hostname):
+                # Don't start on any more hosts once the failures are over budget
+                if halted:
+                    skipped.append(hostname)
+                    return
+
+                try:
+                    scripts[hostname] = self.deploy_host(hostname, Boss.hostlog(Boss.bosslog, {"host": hostname}))
+                except Exception, e:
+                    broken.append(hostname)
+                    Boss.bosslog.error("[{0}] {1}".format(hostname, e), extra={"host": hostname})
+                    raise
+                finally:
+                    failedscripts = sum(len(failures) for failures in scripts.values())
+                    if hostbudget is not None and len(broken) > int(hostbudget):
+                        halted.append("{0} hosts failed, over the budget of {1}".format(len(broken), hostbudget))
+                    elif scriptbudget is not None and failedscripts > int(scriptbudget):
+                        halted.append("{0} scripts failed, over the budget of {1}".format(failedscripts, scriptbudget))
+
+            for (number, wave) in enumerate(waves):
+                if halted:
+                    skipped.extend(wave)
+                    continue
+
+                if len(waves) > 1:
+                    Boss.bosslog.info("Wave {0} of {1}: {2}".format(number + 1, len(waves), ", ".join(wave)))
+                results.update(concurrently(deploy_one, wave, parallel))
+
+            # Summarise the outcome for each host
+            failed = [hostname for hostname in self.hosts if results.get(hostname) is not None]
+            Boss.bosslog.info("Deployment summary:")
+            for hostname in self.hosts:
+                if hostname in skipped:
+                    Boss.bosslog.info("| {0}: SKIPPED".format(hostname))
+                elif results.get(hostname) is not None:
+                    Boss.bosslog.info("| {0}: FAILED ({1})".format(hostname, results[hostname]))
+                elif scripts.get(hostname):
+                    Boss.bosslog.info("| {0}: SCRIPTS FAILED ({1})".format(hostname, ", ".join(scripts[hostname])))
+                else:
+                    Boss.bosslog.info("| {0}: OK".format(hostname))
+
+            if halted:
+                raise Exception("Deployment stopped: {0}; {1} of {2} hosts not deployed to".format(halted[0], len(skipped), len(self.hosts)))
+            if failed:
+                raise Exception("Deployment failed on {0} of {1} hosts: {2}".format(len(failed), len(self.hosts), ", ".join(failed)))
+
+            scriptsfailed = [hostname for hostname in self.hosts if scripts.get(hostname)]
+            if scriptsfailed:
+                raise Exception("Scripts failed on {0} of {1} hosts: {2}".format(len(scriptsfailed), len(self.hosts), ", ".join(scriptsfailed)))
+        finally:
+            if self.payloadhosts:
+                self.removePayload(parallel)
+            if owned:
+                self.connections.close()
+                self.connections = None
+
+    def removePayload(self, parallel=1):
+        """
+        Method to delete the pkg/ payload from the hosts it was sent to but that were never deployed
+        to, such as those skipped once a wave went over its failure budget.
+        """
+
+        (payload, checksum) = self.payload
+
+        def remove_one(hostname):
+            with self.connect(hostname) as remotehost:
+                (status, output) = remotehost.capture("rm -rf {0}".format(os.path.dirname(payload)))
+
+        results = concurrently(remove_one, sorted(self.payloadhosts), parallel)
+        for hostname, error in results.iteritems():
+            if error is not None:
+                Boss.bosslog.debug("[{0}] Could not remove {1}: {2}".format(hostname, payload, error), extra={"host": hostname})
+
+        self.payloadhosts = None
+
+    def rollback(self, parallel=1):
+        """
+        Method to point every host back at its previous release.
+        """
+
+        owned = self.prepareConnections()
+
+        def rollback_one(hostname):
+            try:
+                with self.connect(hostname) as remotehost:
+                    release = remotehost.rollback(self.path)
+            except Exception, e:
+                Boss.bosslog.error("[{0}] {1}".format(hostname, e), extra={"host": hostname})
+                raise
+            Boss.bosslog.info("[{0}] Rolled back to release {1}".format(hostname, release), extra={"host": hostname})
+
+        try:
+            results = concurrently(rollback_one, self.hosts, parallel)
+        finally:
+            if owned:
+                self.connections.close()
+                self.connections = None
+
+        failed = [hostname for hostname in self.hosts if results[hostname] is not None]
+        if failed:
+            raise Exception("Rollback failed on {0} of {1} hosts: {2}".format(len(failed), len(self.hosts), ", ".join(failed)))
+
+    def deploy_host(self, hostname, log=None):
+        """
+        Method to run the full deployment pipeline against a single host.
+
+        Returns: A list of the scripts that failed
+        """
+
+        # Time the whole run for the report, including any failure
+        with Boss.timing(self.report, hostname, "host"):
             # Transfer and run the scripts
             try:
                 # Connect to the remote host
-                remotehost = Boss.client(hostname, self.user)
+                remotehost = self.connect(hostname)
             except Exception, e:
                 raise Exception("""There was an error connecting to host "{0}": {1}""".format(hostname, e))
-            else:
+
+            # The client removes the payload once it's done with it, however it gets on
+            if self.payloadhosts is not None:
+                self.payloadhosts.discard(hostname)
+
+            # The client tidies up after itself, however the deployment ends
+            with remotehost:
                 # Pass through the basedir, environment, project and context to the client object
                 remotehost.environment = self.environment
                 remotehost.project = self.project
                 remotehost.context = self.context
                 remotehost.varmap = self.varmap
+                remotehost.hostvars = self.inventory.variables(hostname)
+                remotehost.transfermode = self.resolve_option("transfer mode", default="sftp")
+                remotehost.deltadelete = self.resolve_flag("delta delete")
+                remotehost.rendered = self.rendered
+                remotehost.detokenjobs = int(self.resolve_option("detoken jobs", default="1"))
+                remotehost.scriptjobs = int(self.resolve_option("script jobs", default="1"))
+                remotehost.largefile = int(float(self.resolve_option("large file size", default="32")) * 1048576)
+                remotehost.channels = int(self.resolve_option("sftp channels", default="4"))
+                remotehost.payload = self.payload
+                remotehost.remotecache = self.resolve_option("remote cache")
+                remotehost.remotecachesize = self.resolve_option("remote cache size")
+                remotehost.release = self.release
+                remotehost.hashes = self.hashes
+                remotehost.compression = self.compression
+                remotehost.keepreleases = int(self.resolve_option("keep releases", default="5"))
+
+                # Tag everything logged for the host, even when it needn't be told apart from others
+                if log is None:
+                    log = Boss.hostlog(Boss.bosslog, {"host": hostname}, prefix=False)
+                remotehost.log = log
 
                 # Send the main configuration templates, config values and pkg/ data
                 try:
@@ -99,15 +591,15 @@ class server():
                 except Exception, e:
                     raise Exception("There was a problem configuring the remote client, {0}: {1}".format(hostname, e))
 
-                Boss.bosslog.info(remotehost)
+                remotehost.log.info(remotehost)
 
                 # Run the detokenisation process
                 remotehost.detoken()
 
-                # Run the common scripts
-                remotehost.deploy(self.common_scriptdir)
+                # Switch over to the new release, if there is one, before running any scripts
+                remotehost.activate()
 
-                # Run the project specific scripts
-                remotehost.deploy()
+                # Run the common scripts, then the project specific scripts
+                results = (remotehost.deploy(self.common_scriptdir) or []) + (remotehost.deploy() or [])
 
-                del remotehost
+                return [script for (script, status, seconds) in results if status != 0]
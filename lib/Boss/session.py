@@ -0,0 +1,91 @@
+import select
+import socket
+
+class session():
+    """
+    Class for the output of a command running on a remote channel, read a line at a time.
+    """
+
+    # The most we'll buffer waiting for a newline before passing on a partial line
+    maxline = 65536
+    blocksize = 32768
+
+    def __init__(self, channel, timing=None):
+        self.channel = channel
+        self.channel.setblocking(0)
+        self.buffer = ""
+        self.status = None
+        self.received = 0
+        self.timing = timing
+
+    def fileno(self):
+        """
+        Class method to allow select() to wait on the channel.
+        """
+
+        return self.channel.fileno()
+
+    def read(self):
+        """
+        Class method to read a block of waiting output, without blocking.  Once the remote side has
+        finished the remaining output is drained, the exit status collected and the channel closed.
+
+        Returns: A list of complete lines
+        """
+
+        try:
+            data = self.channel.recv(self.blocksize)
+        except socket.timeout:
+            return []
+
+        if not data:
+            # End of output; pass on anything left over
+            lines = [self.buffer] if self.buffer else []
+            self.buffer = ""
+            self.channel.setblocking(1)
+            self.status = self.channel.recv_exit_status()
+            self.channel.close()
+
+            if self.timing is not None:
+                self.timing.bytes = self.received
+                self.timing.status = self.status
+                self.timing.finish()
+
+            return lines
+
+        self.received += len(data)
+
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop()
+
+        # Don't let a single line grow without limit
+        while len(self.buffer) > self.maxline:
+            lines.append(self.buffer[:self.maxline])
+            self.buffer = self.buffer[self.maxline:]
+
+        return lines
+
+    def __iter__(self):
+        """
+        Class method to yield each line of output as it arrives, waiting on the channel in between.
+        """
+
+        while self.status is None:
+            select.select([self], [], [])
+            for line in self.read():
+                yield line
+
+def multiplex(sessions):
+    """
+    Function to read from many sessions at once in a single thread, yielding a tuple (session, line)
+    for each line of output as it arrives until every session has finished.
+    """
+
+    pending = list(sessions)
+    while pending:
+        (ready, _, _) = select.select(pending, [], [])
+        for current in ready:
+            for line in current.read():
+                yield (current, line)
+            if current.status is not None:
+                pending.remove(current)
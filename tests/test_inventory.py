@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+import Boss
+
+class expandtest(unittest.TestCase):
+    """
+    Class to check the expansion of host patterns.
+    """
+
+    def test_plain_name(self):
+        self.assertEqual(Boss.expand("web01"), ["web01"])
+
+    def test_padded_range(self):
+        self.assertEqual(Boss.expand("web[08-10]"), ["web08", "web09", "web10"])
+
+    def test_list_with_ranges(self):
+        self.assertEqual(Boss.expand("db[1,3,5-6].dc1"), ["db1.dc1", "db3.dc1", "db5.dc1", "db6.dc1"])
+
+    def test_letters_and_combinations(self):
+        self.assertEqual(Boss.expand("rack[a-b]-[1-2]"), ["racka-1", "racka-2", "rackb-1", "rackb-2"])
+
+    def test_bad_range(self):
+        self.assertRaises(ValueError, Boss.expand, "web[a-10]")
+
+class selecttest(unittest.TestCase):
+    """
+    Class to check the selection of hosts from a host list.
+    """
+
+    def setUp(self):
+        self.inventory = Boss.inventory()
+        for hostname in Boss.expand("web[1-4]"):
+            self.inventory.add(hostname, ["web"], {"rack": "r1" if hostname in ("web1", "web2") else "r2"})
+        for hostname in Boss.expand("db[1-6]"):
+            self.inventory.add(hostname, ["db"])
+
+    def test_list_ranges(self):
+        self.assertEqual(self.inventory.select("db[1,3,5-6]"), ["db1", "db3", "db5", "db6"])
+
+    def test_several_entries(self):
+        self.assertEqual(self.inventory.select("db[1,3], web[2-3] ,db1"), ["db1", "db3", "web2", "web3"])
+
+    def test_groups_and_attributes(self):
+        self.assertEqual(self.inventory.select("@web"), ["web1", "web2", "web3", "web4"])
+        self.assertEqual(self.inventory.select("@rack=r2"), ["web3", "web4"])
+
+    def test_exclusions(self):
+        self.assertEqual(self.inventory.select("@web, !@rack=r1, db[1-2]"), ["web3", "web4", "db1", "db2"])
+        self.assertEqual(self.inventory.select("@db, !db[2,4-5]"), ["db1", "db3", "db6"])
+
+    def test_unknown_group(self):
+        self.assertRaises(Exception, self.inventory.select, "@mail")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "runner.py")
+
+class runnertest(unittest.TestCase):
+    """
+    Class to check the framing written by bin/runner.py.
+    """
+
+    def setUp(self):
+        self.scriptdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scriptdir)
+
+    def script(self, name, body):
+        path = os.path.join(self.scriptdir, name)
+        with open(path, "w") as outfile:
+            outfile.write("#!/bin/sh\n" + body + "\n")
+        os.chmod(path, 0755)
+
+    def run_scripts(self, jobs=1):
+        process = subprocess.Popen([sys.executable, RUNNER, "-j", str(jobs), self.scriptdir], stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        return output.splitlines()
+
+    def test_end_frame_after_unterminated_output(self):
+        self.script("10-failing", "printf failing; exit 1")
+        self.script("20-passing", "echo passing")
+
+        for jobs in (1, 2):
+            lines = self.run_scripts(jobs)
+            self.assertEqual(lines[0], "@@BOSS@@ START 10-failing")
+            self.assertEqual(lines[1], "failing")
+            self.assertTrue(lines[2].startswith("@@BOSS@@ END 1 "))
+            self.assertTrue(lines[2].endswith(" 10-failing"))
+            self.assertEqual(lines[4], "passing")
+            self.assertTrue(lines[5].startswith("@@BOSS@@ END 0 "))
+
+    def test_output_with_newline_left_alone(self):
+        self.script("10-passing", "echo passing")
+
+        lines = self.run_scripts()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1], "passing")
+
+    def test_background_child_not_waited_for(self):
+        self.script("10-daemon", "echo starting; sleep 30 &")
+        self.script("20-passing", "echo passing")
+
+        started = time.time()
+        lines = self.run_scripts()
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual(lines[1], "starting")
+        self.assertTrue(lines[2].startswith("@@BOSS@@ END 0 "))
+        self.assertEqual(lines[4], "passing")
+
+if __name__ == "__main__":
+    unittest.main()